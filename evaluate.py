@@ -1,7 +1,10 @@
 import pandas as pd
-from medhalt.eval.eval_full import FullDataEval
-import glob,os,json
-import ast,re,numpy as np
+from medhalt.eval.scoring import score_folder,parse_groupings
+from medhalt.eval.parser import parse_output,STATUSES
+from medhalt.models.writer import PREDICTION_SUFFIXES,prediction_format,iter_predictions
+import os,json
+from collections import deque,Counter
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
 
 pred_prefix_dict = {
     'abs2pub':  "IR_abstract2pubmedlink",
@@ -15,65 +18,77 @@ pred_prefix_dict = {
 
 ds_name_dict = {v:k for k,v in pred_prefix_dict.items()}
 
-def escaped_(data: str):
-    if "'" in data:
-        escaped_str = re.sub(r"(?<=\w)(')(?=\w)", r"\"", data)
-    else:
-        escaped_str = re.sub(r'(?<=\w)(")(?=\w)', r"\'", data)
-    
-#     print(escaped_str)
-    return escaped_str
+def generation_files(prediction_folder):
+    """The generation output of every dataset in `prediction_folder`, <prefix>.csv, <prefix>.predictions.jsonl or
+    <prefix>.predictions.parquet. The jsonl and parquet ones win over a csv of the same dataset."""
+    pred_files = {}
+    for output_format in ["csv","parquet","jsonl"]:
+        for prefix in pred_prefix_dict:
+            pred_file = os.path.join(prediction_folder,prefix + PREDICTION_SUFFIXES[output_format])
+            if os.path.exists(pred_file):
+                pred_files[prefix] = pred_file
+    return sorted(pred_files.values())
 
-def parse_key_values(out_str):
-    #regex = r"""['"]{key}['"]\s*:\s*['"]*(.*?)['"]*\s*[,}}]""".format(key=key)
-    regex = r"""['"](.*?)['"]\s*:\s*['"]*(.*?)['"]*\s*[,}]"""
-    regex = re.compile(regex)
-    return regex.findall(out_str)
+def convert_chunk(records):
+    # runs in a worker process, returns the json encoded records and how their outputs parsed
+    statuses = Counter()
+    for record in records:
+        record["output"],record["parse_status"] = parse_output(record["output"])
+        statuses[record["parse_status"]] += 1
+    return [json.dumps(record) for record in records],statuses
 
-def recreate(out_str):
-    kvs = parse_key_values(out_str)
-    return {kv[0].replace("\\",""):kv[1] for kv in kvs}
+def convert_file(pred_file,dataset_folder,output_folder,executor,chunk_size=2048,jsonl=False,max_pending=8):
+    prefix = os.path.basename(pred_file).split(".")[0]
+    dataset_name = pred_prefix_dict[prefix]
+    dataset_df = pd.read_csv(os.path.join(dataset_folder,f"{dataset_name}.csv"))
+    print(f"Merging and converting the prediction to Json files - {dataset_name}")
     
-def clean_output(id,out_str):
-    try:
-        if np.isnan(out_str):
-            import pdb;pdb.set_trace()
-        out_str = out_str.strip().split("\n")[0]
-        out_str = out_str.replace("Stop Here","")
-        out_str = out_str.strip()
-        out_str = out_str.replace("'s","s")
-        #out_str = re.sub(r":\s*'",':"""',out_str)
-        #out_str = re.sub(r"'\s*}",'"""}',out_str)
-        #out_str = re.sub(r"'\s*,",'""",',out_str)
-        out_str = escaped_(out_str)
-        return ast.literal_eval(out_str)
-    except Exception as e:
-        #{'cop'\s*:(.*),\s*['"]cop_index['"]:(.*),\s*['"]why_correct['"]:(.*),\s*['"]why_others_incorrect['"]:(.*)}
-         b_str = out_str 
-         out_str = recreate(out_str)
-         if len(out_str.keys()) == 0:
-             print(b_str)
-         print("Exception during parsing data - recreated str",id,out_str,b_str)
-         return out_str
-     
-def convert_to_json(prediction_folder,dataset_folder):    
-    
-    pred_files = glob.glob(os.path.join(prediction_folder,"*.csv")) 
-    for pred_file in pred_files:
-        if os.path.basename(pred_file)=='results.csv':
-            continue;
-        filename = os.path.basename(pred_file)
-        prefix = filename.split(".")[0]
-        dataset_name = pred_prefix_dict[prefix]
-        dataset_df = pd.read_csv(os.path.join(dataset_folder,f"{dataset_name}.csv"))
-        pred_df = pd.read_csv(pred_file,names=["id","output"])
-        merge_df = pd.merge(left=dataset_df,right=pred_df,on=['id'])
-        merge_df["output"] = merge_df[['id','output']].fillna("").apply(lambda params : clean_output(*params),axis='columns')
-        merge_dict = merge_df.to_dict(orient='records')
+    out_file = os.path.join(output_folder,f"{dataset_name}.jsonl" if jsonl else f"{dataset_name}.json")
+    pending = deque()
+    statuses = Counter()
+    count = 0
+    with open(out_file + ".tmp",'w') as fp:
+        fp.write("" if jsonl else "[")
+        
+        def write(future):
+            nonlocal count
+            lines,chunk_statuses = future.result()
+            statuses.update(chunk_statuses)
+            if lines:
+                if jsonl:
+                    fp.write("\n".join(lines) + "\n")
+                else:
+                    fp.write((", " if count else "") + ", ".join(lines))
+                count += len(lines)
         
-        print(f"Merging and converting the prediction to Json files - {dataset_name}")
-        with open(os.path.join(prediction_folder,f"{dataset_name}.json"),'w') as fp:
-            json.dump(merge_dict,fp)
+        for pred_df in iter_predictions(pred_file,chunk_size):
+            if prediction_format(pred_file) != "csv":
+                # jsonl and parquet store the ids as strings, csv ids were parsed like the dataset ones
+                pred_df["id"] = pred_df["id"].astype(dataset_df["id"].dtype)
+            merge_df = pd.merge(left=dataset_df,right=pred_df,on=['id'])
+            pending.append(executor.submit(convert_chunk,merge_df.to_dict(orient='records')))
+            # chunks are written in order, a few are kept in flight to bound memory
+            if len(pending) >= max_pending:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+        fp.write("" if jsonl else "]")
+    os.replace(out_file + ".tmp",out_file)
+    print(f"{dataset_name} - parsed outputs: " + ", ".join(f"{status} {statuses[status]}" for status in STATUSES))
+    return out_file
+
+def convert_to_json(prediction_folder,dataset_folder,num_workers=None,chunk_size=2048,jsonl=False):
+    """Converts every generation file of `prediction_folder` to <dataset>.json (or .jsonl), the files are
+    converted concurrently and their chunks parsed in a shared process pool."""
+    pred_files = generation_files(prediction_folder)
+    if not pred_files:
+        return []
+    num_workers = num_workers or os.cpu_count()
+    with ProcessPoolExecutor(num_workers) as executor, ThreadPoolExecutor(len(pred_files)) as files_executor:
+        futures = [files_executor.submit(convert_file,pred_file,dataset_folder,prediction_folder,executor,chunk_size,jsonl,
+                                         max(2,2 * num_workers // len(pred_files)))
+                   for pred_file in pred_files]
+        return [future.result() for future in futures]
 
 if __name__ == "__main__":
     import argparse
@@ -83,17 +98,27 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_folder",type=str)
     parser.add_argument("--do_json_conversion",action='store_true')
     parser.add_argument("--point_score",action='store_true')
+    parser.add_argument("--num_workers",type=int,help="processes parsing predictions, defaults to the cpu count")
+    parser.add_argument("--chunk_size",type=int,default=2048)
+    parser.add_argument("--jsonl",action='store_true',help="write json lines instead of one json array per dataset")
+    parser.add_argument("--schemes",type=str,default="1:1,1:-0.25",help="correct_score:incorrect_score pairs scored from one pass")
+    parser.add_argument("--group_by",type=str,help="also write results_by_group.csv, e.g. 'subject_name;exam_name,year' (comma separated fields are crossed)")
     
     args = parser.parse_args()
-    results_df = pd.DataFrame()
     
     if args.do_json_conversion:
-        convert_to_json(args.prediction_folder,args.dataset_folder)
-        
-    for incorrect_score in [1,-0.25]:
-        evaluator = FullDataEval(args.prediction_folder,1,incorrect_score)
-        full_df = evaluator.run_all_evaluations()
-        full_df["point_score"] = (incorrect_score==-0.25)
-        results_df = pd.concat([full_df,results_df],ignore_index=True)
+        convert_to_json(args.prediction_folder,args.dataset_folder,args.num_workers,args.chunk_size,args.jsonl)
     
-    results_df.to_csv(os.path.join(args.prediction_folder,"results.csv"),index=False)
\ No newline at end of file
+    schemes = [tuple(float(score) for score in scheme.split(":")) for scheme in args.schemes.split(",")]
+    if args.group_by:
+        # the totals and the strata come from one pass over the prediction files
+        results_df,grouped_df = score_folder(args.prediction_folder,schemes,num_workers=args.num_workers,
+                                             groupings=parse_groupings(args.group_by),totals=True)
+    else:
+        results_df = score_folder(args.prediction_folder,schemes,num_workers=args.num_workers)
+    results_df["point_score"] = results_df["incorrect_score"] == -0.25
+    results_df.to_csv(os.path.join(args.prediction_folder,"results.csv"),index=False)
+
+    if args.group_by:
+        grouped_df["point_score"] = grouped_df["incorrect_score"] == -0.25
+        grouped_df.to_csv(os.path.join(args.prediction_folder,"results_by_group.csv"),index=False)
@@ -0,0 +1,122 @@
+import os,glob,json,hashlib
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from evaluate import convert_to_json,generation_files
+from medhalt.eval.scoring import DEFAULT_SCHEMES,score_folder,prediction_files
+
+STATE_FILE = ".leaderboard_state.json"
+
+def model_prediction_files(folder):
+    # the generation outputs when there are any, the scored json files otherwise
+    return generation_files(folder) or list(prediction_files(folder).values())
+
+def discover_models(prediction_root):
+    models = {}
+    for folder in sorted(glob.glob(os.path.join(prediction_root,"*"))):
+        if os.path.isdir(folder) and model_prediction_files(folder):
+            models[os.path.basename(folder)] = folder
+    return models
+
+def path_files(path):
+    # parquet predictions are a folder of part files
+    return sorted(glob.glob(os.path.join(path,"*.parquet"))) if os.path.isdir(path) else [path]
+
+def file_hash(path,block_size=1 << 20):
+    digest = hashlib.sha256()
+    for file_path in path_files(path):
+        with open(file_path,'rb') as fp:
+            for block in iter(lambda: fp.read(block_size),b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def fingerprint(folder,previous=None):
+    """size, mtime and sha256 of every prediction file, the hash is reused while size and mtime are unchanged."""
+    previous = previous or {}
+    files = {}
+    for path in model_prediction_files(folder):
+        stats = [os.stat(file_path) for file_path in path_files(path)]
+        size,mtime = sum(stat.st_size for stat in stats),max((stat.st_mtime_ns for stat in stats),default=0)
+        name = os.path.basename(path)
+        known = previous.get(name)
+        if known and known["size"] == size and known["mtime"] == mtime:
+            files[name] = known
+        else:
+            files[name] = {"size":size,"mtime":mtime,"sha256":file_hash(path)}
+    return files
+
+def same_predictions(files,previous):
+    return previous is not None and {name:entry["sha256"] for name,entry in files.items()} == \
+        {name:entry["sha256"] for name,entry in previous.items()}
+
+def evaluate_model(folder,dataset_folder,schemes,convert_workers):
+    if dataset_folder and generation_files(folder):
+        convert_to_json(folder,dataset_folder,convert_workers)
+    return score_folder(folder,schemes,num_workers=convert_workers).to_dict(orient="records")
+
+def build_leaderboard(prediction_root,dataset_folder=None,schemes=DEFAULT_SCHEMES,num_workers=None,output=None,force=False):
+    """Scores every model folder under `prediction_root` whose predictions changed since the last run and writes
+    one combined table, the other models keep their stored rows."""
+    state_path = os.path.join(prediction_root,STATE_FILE)
+    state = {}
+    if os.path.exists(state_path) and not force:
+        with open(state_path,'r') as fp:
+            state = json.load(fp)
+    # rows scored with other schemes cannot be reused
+    schemes = [list(scheme) for scheme in schemes]
+    if state.get("schemes") != schemes:
+        state = {"schemes":schemes,"models":{}}
+
+    models = discover_models(prediction_root)
+    fingerprints,stale = {},[]
+    for model,folder in models.items():
+        previous = state["models"].get(model,{}).get("files")
+        fingerprints[model] = fingerprint(folder,previous)
+        if not same_predictions(fingerprints[model],previous):
+            stale.append(model)
+    print(f"{len(models)} models, {len(stale)} to score: {', '.join(stale)}")
+
+    num_workers = num_workers or os.cpu_count()
+    if stale:
+        # models are scored side by side, each converts its own files with a share of the cores
+        pool_size = min(num_workers,len(stale))
+        with ProcessPoolExecutor(pool_size) as executor:
+            futures = {model:executor.submit(evaluate_model,models[model],dataset_folder,schemes,max(1,num_workers // pool_size))
+                       for model in stale}
+            for model,future in futures.items():
+                try:
+                    state["models"][model] = {"files":fingerprints[model],"rows":future.result()}
+                except Exception as e:
+                    print(f"Failed to score {model} - {e}")
+                    state["models"].pop(model,None)
+
+    # models whose folder is gone leave the leaderboard
+    state["models"] = {model:entry for model,entry in state["models"].items() if model in models}
+    for model,entry in state["models"].items():
+        # refresh the mtimes of files that were touched without changing
+        entry["files"] = fingerprints[model]
+    with open(state_path + ".tmp",'w') as fp:
+        json.dump(state,fp)
+    os.replace(state_path + ".tmp",state_path)
+
+    rows = [dict(row,model=model) for model,entry in sorted(state["models"].items()) for row in entry["rows"]]
+    results_df = pd.DataFrame(rows)
+    if not results_df.empty:
+        results_df = results_df[["model"] + [column for column in results_df.columns if column != "model"]]
+        results_df["point_score"] = results_df["incorrect_score"] == -0.25
+    results_df.to_csv(output or os.path.join(prediction_root,"leaderboard.csv"),index=False)
+    return results_df
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Score every model folder of a prediction root into one results table")
+    parser.add_argument("--prediction_root",type=str)
+    parser.add_argument("--dataset_folder",type=str,help="needed to convert generation csvs to json")
+    parser.add_argument("--output",type=str,help="defaults to <prediction_root>/leaderboard.csv")
+    parser.add_argument("--num_workers",type=int,help="defaults to the cpu count")
+    parser.add_argument("--schemes",type=str,default="1:1,1:-0.25",help="correct_score:incorrect_score pairs")
+    parser.add_argument("--force",action="store_true",help="rescore every model")
+
+    args = parser.parse_args()
+    schemes = [tuple(float(score) for score in scheme.split(":")) for scheme in args.schemes.split(",")]
+    build_leaderboard(args.prediction_root,args.dataset_folder,schemes,args.num_workers,args.output,args.force)
@@ -0,0 +1,96 @@
+import ast,re,os,glob,time
+import numpy as np
+import pandas as pd
+from collections import Counter
+from medhalt.eval.parser import parse_output,STATUSES
+
+# the parser evaluate.py used before medhalt.eval.parser, kept as the benchmark baseline
+
+
+def escaped_(data: str):
+    if "'" in data:
+        escaped_str = re.sub(r"(?<=\w)(')(?=\w)", r"\"", data)
+    else:
+        escaped_str = re.sub(r'(?<=\w)(")(?=\w)', r"\'", data)
+    return escaped_str
+
+def parse_key_values(out_str):
+    regex = r"""['"](.*?)['"]\s*:\s*['"]*(.*?)['"]*\s*[,}]"""
+    regex = re.compile(regex)
+    return regex.findall(out_str)
+
+def recreate(out_str):
+    kvs = parse_key_values(out_str)
+    return {kv[0].replace("\\",""):kv[1] for kv in kvs}
+
+def legacy_clean_output(out_str):
+    # np.isnan raises on every string, so real generations always took the recreate() branch; the
+    # pdb.set_trace() that followed it is left out
+    try:
+        if np.isnan(out_str):
+            return {}
+        out_str = out_str.strip().split("\n")[0]
+        out_str = out_str.replace("Stop Here","")
+        out_str = out_str.strip()
+        out_str = out_str.replace("'s","s")
+        out_str = escaped_(out_str)
+        return ast.literal_eval(out_str)
+    except Exception:
+        return recreate(out_str)
+
+
+def load_outputs(prediction_folder):
+    outputs = []
+    for pred_file in glob.glob(os.path.join(prediction_folder,"**","*.csv"),recursive=True):
+        if os.path.basename(pred_file) == 'results.csv':
+            continue
+        pred_df = pd.read_csv(pred_file,names=["id","output"])
+        outputs.extend(pred_df["output"].fillna("").astype(str).tolist())
+    return outputs
+
+def timed(parse_fn,outputs,repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parse_fn(output) for output in outputs]
+        best = min(best,time.perf_counter() - start)
+    return results,best
+
+def normalise(parsed):
+    # the legacy parser returns strings, compare values as lower cased text
+    if not isinstance(parsed,dict):
+        return None
+    return {str(key).strip():str(value).strip().lower() for key,value in parsed.items()}
+
+def run_benchmark(prediction_folder,repeat=3,show=5):
+    outputs = load_outputs(prediction_folder)
+    print(f"{len(outputs)} outputs")
+    if not outputs:
+        return
+
+    legacy,legacy_time = timed(legacy_clean_output,outputs,repeat)
+    parsed,parser_time = timed(parse_output,outputs,repeat)
+    print(f"legacy  {legacy_time:.3f}s  {len(outputs) / legacy_time:,.0f} outputs/s")
+    print(f"parser  {parser_time:.3f}s  {len(outputs) / parser_time:,.0f} outputs/s  ({legacy_time / parser_time:.1f}x)")
+
+    statuses = Counter(status for _,status in parsed)
+    print("status  " + ", ".join(f"{status} {statuses[status]}" for status in STATUSES))
+
+    disagreements = [index for index,(old,(new,_)) in enumerate(zip(legacy,parsed)) if normalise(old) != normalise(new)]
+    print(f"{len(disagreements)} outputs parsed differently from the legacy parser")
+    # one example per distinct output
+    examples = list({outputs[index]:index for index in reversed(disagreements)}.values())[::-1]
+    for index in examples[:show]:
+        print(f"\n{outputs[index]!r}\n  legacy: {legacy[index]!r}\n  parser: {parsed[index][0]!r} ({parsed[index][1]})")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare medhalt.eval.parser with the legacy clean_output on prediction csvs")
+    parser.add_argument("--prediction_folder",type=str)
+    parser.add_argument("--repeat",type=int,default=3)
+    parser.add_argument("--show",type=int,default=5,help="disagreements to print")
+
+    args = parser.parse_args()
+    run_benchmark(args.prediction_folder,args.repeat,args.show)
@@ -0,0 +1,212 @@
+import re
+
+# parse status of a model output, from best to worst
+OK = "ok"                # a well formed dict
+REPAIRED = "repaired"    # a dict once stray quotes, missing separators or unquoted text were tolerated
+TRUNCATED = "truncated"  # the output ended inside the dict, the pairs completed before that are kept
+EMPTY = "empty"          # nothing was generated
+FAILED = "failed"        # no key/value pair could be read
+
+STATUSES = [OK, REPAIRED, TRUNCATED, EMPTY, FAILED]
+
+STOP_SEQUENCE = "Stop Here"
+
+# a quote only closes a string when what follows could come after a string, so apostrophes such as
+# 'Crohn's disease' stay inside it
+_CLOSE = r"""\s*(?:$|[:}\]]|['"][\w ]+['"]\s*:|,\s*(?:$|['"{}\[\]]|[\w ]+['"]?\s*:))"""
+_SINGLE = r"""'([^'\\]*(?:(?:\\.|'(?!%s))[^'\\]*)*)'(?=%s)""" % (_CLOSE, _CLOSE)
+_DOUBLE = r'''"([^"\\]*(?:(?:\\.|"(?!%s))[^"\\]*)*)"(?=%s)''' % (_CLOSE, _CLOSE)
+_TOKEN = re.compile(r"""
+    {single}
+  | {double}
+  | (?P<punct>[{{}}\[\]:,])
+  | (?P<unterminated>['"].*)
+  | (?P<bare>[^{{}}\[\]:,'"\s]+(?:\s+[^{{}}\[\]:,'"\s]+)*)
+""".format(single=_SINGLE.replace("(", "(?P<single>", 1), double=_DOUBLE.replace("(", "(?P<double>", 1)), re.VERBOSE | re.DOTALL)
+# most outputs are flat dicts of strings and numbers, their pairs are matched whole without tokenizing
+_PAIR = re.compile(r"(?:{single}|{double})\s*:\s*(?:{single}|{double}|(-?\d+(?:\.\d+)?|True|False|None))\s*(,\s*)?".format(
+    single=_SINGLE, double=_DOUBLE), re.DOTALL)
+_SPACE = re.compile(r"\s*")
+_STRAY = {"single": re.compile(r"(?<!\\)'"), "double": re.compile(r'(?<!\\)"')}
+_ESCAPE = re.compile(r"\\(.)")
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+_CONSTANTS = {"True": True, "False": False, "None": None, "true": True, "false": False, "null": None}
+
+
+class _Truncated(Exception):
+    pass
+
+
+def _unescape(text):
+    return _ESCAPE.sub(lambda match: _ESCAPES.get(match.group(1), match.group(1)), text) if "\\" in text else text
+
+
+class _Parser(object):
+    """Recursive descent over the tokens of a python/json like literal that tolerates what models get wrong."""
+
+    def __init__(self, kinds, values):
+        self.kinds = kinds
+        self.values = values
+        self.pos = 0
+        self.repaired = False
+        self.partial = None
+
+    def peek(self):
+        if self.pos >= len(self.kinds):
+            raise _Truncated()
+        return self.kinds[self.pos], self.values[self.pos]
+
+    def value(self):
+        kind, value = self.peek()
+        if kind == "punct":
+            if value == "{":
+                return self.mapping()
+            if value == "[":
+                return self.sequence()
+            # a missing value, the separator is left to the caller
+            self.repaired = True
+            return ""
+        if kind == "unterminated":
+            raise _Truncated()
+        self.pos += 1
+        if kind == "bare":
+            return self.bare(value)
+        if _STRAY[kind].search(value):
+            self.repaired = True
+        return _unescape(value)
+
+    def bare(self, token):
+        if token in _CONSTANTS:
+            return _CONSTANTS[token]
+        for cast in (int, float):
+            try:
+                return cast(token)
+            except ValueError:
+                pass
+        # unquoted text
+        self.repaired = True
+        return token
+
+    def separator(self, closer):
+        # returns True once the closing bracket has been consumed
+        token = self.peek()
+        if token == ("punct", closer):
+            self.pos += 1
+            return True
+        if token == ("punct", ","):
+            self.pos += 1
+            if self.peek() == ("punct", closer):
+                self.pos += 1
+                return True
+            return False
+        self.repaired = True
+        if token[0] == "punct" and token[1] in ":}]":
+            # a bracket or colon out of place, step over it so the parse always moves on
+            self.pos += 1
+        return False
+
+    def mapping(self):
+        self.pos += 1
+        result = {}
+        try:
+            if self.peek() == ("punct", "}"):
+                self.pos += 1
+                return result
+            while True:
+                key = self.value()
+                if self.peek() != ("punct", ":"):
+                    # a key without a value
+                    self.repaired = True
+                else:
+                    self.pos += 1
+                    result[str(key).replace("\\", "")] = self.value()
+                if self.separator("}"):
+                    return result
+        except _Truncated:
+            self.partial = result
+            raise
+
+    def sequence(self):
+        self.pos += 1
+        result = []
+        if self.peek() == ("punct", "]"):
+            self.pos += 1
+            return result
+        while True:
+            result.append(self.value())
+            if self.separator("]"):
+                return result
+
+
+def clean(text):
+    """The part of a generation that holds the answer, its first line without the stop sequence."""
+    text = text.strip().split("\n")[0]
+    return text.replace(STOP_SEQUENCE, "").strip()
+
+
+def _flat(text):
+    # returns the dict and whether a stray quote had to be kept inside a string, None if `text` is not flat
+    pos = _SPACE.match(text, 1).end()
+    result = {}
+    repaired = False
+    while pos < len(text) - 1:
+        match = _PAIR.match(text, pos)
+        if match is None:
+            return None
+        key_single, key_double, single, double, literal, comma = match.groups()
+        key = key_single if key_single is not None else key_double
+        if literal is not None:
+            value = _CONSTANTS[literal] if literal in _CONSTANTS else (float(literal) if "." in literal else int(literal))
+        elif single is not None:
+            value = single
+            repaired = repaired or "'" in single
+        else:
+            value = double
+            repaired = repaired or '"' in double
+        if "\\" in key or (literal is None and "\\" in value):
+            return None
+        result[key] = value
+        pos = match.end()
+        repaired = repaired or (comma is None and pos < len(text) - 1)
+    if pos != len(text) - 1 or text[pos] != "}":
+        return None
+    return result, repaired
+
+
+def tokenize(text):
+    kinds, values = [], []
+    for match in _TOKEN.finditer(text):
+        kinds.append(match.lastgroup)
+        values.append(match.group(match.lastgroup))
+    return kinds, values
+
+
+def parse_output(text):
+    """Parses a generated dict like answer, returns `(dict, status)` where status is one of `STATUSES`."""
+    if not isinstance(text, str):
+        # NaN or None for samples without a generation
+        return {}, EMPTY
+    text = clean(text)
+    if not text:
+        return {}, EMPTY
+    start = text.find("{")
+    if start < 0:
+        return {}, FAILED
+
+    if start == 0 and text[-1] == "}":
+        flat = _flat(text)
+        if flat is not None:
+            result, repaired = flat
+            return result, (REPAIRED if repaired else OK) if result else FAILED
+
+    parser = _Parser(*tokenize(text[start:]))
+    try:
+        result = parser.mapping()
+    except _Truncated:
+        result = parser.partial or {}
+        return result, TRUNCATED if result else FAILED
+    if not result:
+        return result, FAILED
+    if parser.repaired or start > 0 or parser.pos < len(parser.kinds):
+        return result, REPAIRED
+    return result, OK
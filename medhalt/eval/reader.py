@@ -0,0 +1,85 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def loads(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN that pandas writes for empty dataset fields
+            pass
+    return json.loads(text)
+
+
+def iter_jsonl(path):
+    with open(path, 'rb') as fp:
+        for line in fp:
+            if line.strip():
+                yield loads(line)
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """Yields the items of a top level json array one at a time, only the current item and one chunk are held."""
+    with open(path, 'r', encoding='utf-8') as fp:
+        buffer = ""
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            # drop what was consumed and make sure there is something to decode
+            while True:
+                while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                buffer, pos = fp.read(chunk_size), 0
+                eof = not buffer
+            if pos >= len(buffer):
+                if started:
+                    raise ValueError(f"{path} ends inside the json array")
+                return
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"{path} does not hold a json array")
+                started = True
+                pos += 1
+                continue
+            if char == "]":
+                return
+            if char == ",":
+                pos += 1
+                continue
+            try:
+                item, end = _decoder.raw_decode(buffer, pos)
+                # an item is only complete once the separator after it is in the buffer, a number cut by
+                # the chunk boundary would otherwise be read short
+                after = end
+                while after < len(buffer) and buffer[after] in _WHITESPACE:
+                    after += 1
+                if after == len(buffer) or buffer[after] not in ",]":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, after)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = fp.read(chunk_size)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield item
+            pos = end
+
+
+def iter_records(path):
+    """Streams the records of a `.jsonl` file or of a `.json` file holding one array."""
+    if path.endswith(".jsonl"):
+        return iter_jsonl(path)
+    return iter_json_array(path)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+# every sample is correct, wrong or an exception, so resampling the samples of a task with replacement is the same
+# as drawing the three counts from a multinomial: a bootstrap replicate costs one draw whatever the task size
+
+N_BOOT = 2000
+N_PERMUTATIONS = 10000
+
+
+def bootstrap_counts(counts, n_boot=N_BOOT, seed=0):
+    """(rows, n_boot, 3) resampled (correct, wrong, exception) counts of a (rows, 3) array of task counts."""
+    counts = np.asarray(counts, dtype=np.int64).reshape(-1, 3)
+    n = counts.sum(axis=1)
+    # an empty task keeps drawing nothing
+    pvals = np.where(n[:, None] > 0, counts / np.maximum(n, 1)[:, None], [0, 0, 1])
+    return np.random.default_rng(seed).multinomial(n[:, None], pvals[:, None, :], size=(len(counts), n_boot))
+
+
+def bootstrap_intervals(counts, schemes, n_boot=N_BOOT, alpha=0.05, seed=0, chunk_size=256):
+    """Percentile intervals of accuracy and score of every row of `counts`, computed the way finalise_dataframe and
+    score_rows compute them. `schemes` holds the (correct_score, incorrect_score) of each row."""
+    counts = np.asarray(counts, dtype=np.int64).reshape(-1, 3)
+    schemes = np.asarray(schemes, dtype=float).reshape(-1, 2)
+    quantiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    accuracy = np.full((len(counts), 2), np.nan)
+    score = np.full((len(counts), 2), np.nan)
+    # rows with the same counts (one per scheme, small strata) share their replicates
+    distinct, inverse = np.unique(counts, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # the replicates are drawn a chunk at a time to bound their memory
+    for start in range(0, len(distinct), chunk_size):
+        samples = bootstrap_counts(distinct[start:start + chunk_size], n_boot, seed).astype(float)
+        correct, wrong = samples[..., 0], samples[..., 1]
+        total = correct + wrong
+        with np.errstate(invalid='ignore', divide='ignore'):
+            replicates = np.where(total > 0, correct / total * 100, np.nan)
+        defined = ~np.isnan(replicates).any(axis=1)
+        chunk_accuracy = np.full((len(samples), 2), np.nan)
+        chunk_accuracy[defined] = np.percentile(replicates[defined], quantiles, axis=1).T
+        partial = ~defined & ~np.isnan(replicates).all(axis=1)
+        if partial.any():
+            chunk_accuracy[partial] = np.nanpercentile(replicates[partial], quantiles, axis=1).T
+        rows = np.nonzero((inverse >= start) & (inverse < start + len(samples)))[0]
+        local = inverse[rows] - start
+        accuracy[rows] = chunk_accuracy[local]
+        replicates = (correct[local] * schemes[rows, :1] + wrong[local] * schemes[rows, 1:]) / 100
+        score[rows] = np.percentile(replicates, quantiles, axis=1).T
+    return accuracy.round(3), score
+
+
+def bootstrap_ci(counts, correct_score=1, incorrect_score=-0.25, n_boot=N_BOOT, alpha=0.05, seed=0):
+    """Intervals of one task's (correct, wrong, exception) counts."""
+    accuracy, score = bootstrap_intervals([counts], [(correct_score, incorrect_score)], n_boot, alpha, seed)
+    return {'accuracy_ci_low': float(accuracy[0, 0]), 'accuracy_ci_high': float(accuracy[0, 1]),
+            'score_ci_low': float(score[0, 0]), 'score_ci_high': float(score[0, 1])}
+
+
+def add_confidence_intervals(df, n_boot=N_BOOT, alpha=0.05, seed=0):
+    """Adds bootstrap interval columns to a frame of score_rows, rows without a scheme get accuracy intervals only."""
+    counts = df[['correct', 'wrong', 'exception_count']].to_numpy(dtype=np.int64)
+    has_scheme = 'correct_score' in df.columns
+    schemes = df[['correct_score', 'incorrect_score']].to_numpy(dtype=float) if has_scheme else np.zeros((len(df), 2))
+    accuracy, score = bootstrap_intervals(counts, schemes, n_boot, alpha, seed)
+    if not has_scheme:
+        score[:] = np.nan
+    intervals = pd.DataFrame(np.hstack([accuracy, score]), index=df.index,
+                             columns=['accuracy_ci_low', 'accuracy_ci_high', 'score_ci_low', 'score_ci_high'])
+    return pd.concat([df, intervals], axis=1)
+
+
+def sample_scores(accumulator, correct_score=1, incorrect_score=-0.25):
+    """Per sample score of a filled TaskAccumulator indexed by sample id, exceptions score 0."""
+    correct, wrong, _ = accumulator.masks()
+    scores = pd.Series(correct * correct_score + wrong * incorrect_score, index=accumulator.ids, dtype=float)
+    return scores[~scores.index.duplicated()]
+
+
+def paired_permutation_test(baseline, candidate, n_permutations=N_PERMUTATIONS, seed=0):
+    """Two sided paired permutation test on the mean per sample score of the samples both Series hold.
+
+    Under the null hypothesis the two scores of a sample are exchangeable, i.e. every difference keeps or flips its
+    sign with probability 1/2. Differences only take a handful of values, so the signed sum of the k differences
+    equal to d is d * (2 * Binomial(k, 1/2) - k) and one permutation costs a draw per distinct difference."""
+    baseline, candidate = baseline.align(candidate, join='inner')
+    differences = (candidate - baseline).to_numpy(dtype=float)
+    n = len(differences)
+    if n == 0:
+        return {'n': 0, 'baseline': np.nan, 'candidate': np.nan, 'difference': np.nan, 'p_value': np.nan}
+    observed = differences.sum()
+    values, occurrences = np.unique(differences[differences != 0], return_counts=True)
+    rng = np.random.default_rng(seed)
+    kept = rng.binomial(occurrences, 0.5, size=(n_permutations, len(values)))
+    permuted = ((2 * kept - occurrences) * values).sum(axis=1)
+    # the observed assignment counts as one of the permutations
+    p_value = (1 + np.count_nonzero(np.abs(permuted) >= abs(observed) - 1e-9)) / (n_permutations + 1)
+    return {'n': n, 'baseline': float(baseline.mean()), 'candidate': float(candidate.mean()),
+            'difference': float(observed / n), 'p_value': float(p_value)}
+
+
+if __name__ == "__main__":
+    import argparse
+    from medhalt.eval.scoring import compare_folders
+
+    parser = argparse.ArgumentParser(description="Paired permutation test of the task scores of two prediction folders")
+    parser.add_argument("--baseline",type=str)
+    parser.add_argument("--candidate",type=str)
+    parser.add_argument("--schemes",type=str,default="1:-0.25",help="correct_score:incorrect_score pairs")
+    parser.add_argument("--recursive",action="store_true")
+
+    args = parser.parse_args()
+    schemes = [tuple(float(score) for score in scheme.split(":")) for scheme in args.schemes.split(",")]
+    print(compare_folders(args.baseline,args.candidate,schemes,args.recursive).to_string(index=False))
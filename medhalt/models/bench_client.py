@@ -0,0 +1,108 @@
+import os,time,tempfile
+import numpy as np
+import pandas as pd
+from medhalt.models.model import Model
+from medhalt.models.mock_server import MockTGIServer,LATENCY_DISTRIBUTIONS
+
+# drives Model.rest_generate, the client run_inference.sh uses, against MockTGIServer
+
+
+class TimedPrompts:
+    """List of {'prompt','id'} samples that notes when the client takes each one, i.e. when its request is sent."""
+
+    dataset_name = "bench"
+
+    def __init__(self,samples) -> None:
+        self.samples = samples
+        self.sent = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self,index):
+        sample = self.samples[index]
+        self.sent[sample["id"]] = time.perf_counter()
+        return sample
+
+
+class TimedModel(Model):
+
+    def __init__(self,*args,**kwargs) -> None:
+        super().__init__(*args,**kwargs)
+        self.completed = {}
+
+    def cache_generation(self,cache_keys,_id,text):
+        self.completed[_id] = time.perf_counter()
+        super().cache_generation(cache_keys,_id,text)
+
+
+def synthetic_prompts(num_requests,prompt_words=200):
+    prompt = " ".join(["word"] * prompt_words)
+    return [{"prompt":prompt,"id":str(index)} for index in range(num_requests)]
+
+
+def run_point(batch_size,concurrency,num_requests,server_kwargs,gen_kwargs,prompt_words=200,max_attempts=5):
+    server = MockTGIServer(max_batch_size=batch_size,**server_kwargs)
+    url = server.start()
+    try:
+        model = TimedModel("mock/model",rest_client=url,max_in_flight=concurrency,max_attempts=max_attempts,backoff_base=0.01)
+        prompts = TimedPrompts(synthetic_prompts(num_requests,prompt_words))
+        with tempfile.TemporaryDirectory() as folder:
+            pred_file = os.path.join(folder,"bench.csv")
+            server.stats.reset()
+            start = time.perf_counter()
+            model.rest_generate(prompts,pred_file,**gen_kwargs)
+            elapsed = time.perf_counter() - start
+        stats = server.stats.snapshot(batch_size)
+    finally:
+        server.stop()
+
+    latencies = np.array([model.completed[_id] - prompts.sent[_id] for _id in model.completed]) * 1000
+    p50,p95,p99 = np.percentile(latencies,[50,95,99]) if len(latencies) else (np.nan,np.nan,np.nan)
+    return {"batch_size":batch_size,"concurrency":concurrency,"requests":num_requests,"completed":len(latencies),
+            "failed":num_requests - len(latencies),"server_errors":stats["errors"],"seconds":elapsed,
+            "rps":len(latencies) / elapsed,"p50_ms":p50,"p95_ms":p95,"p99_ms":p99,
+            "utilisation":stats["utilisation"],"mean_queue_ms":stats["queue_time"] / max(1,stats["requests"]) * 1000}
+
+
+def run_benchmark(batch_sizes,concurrency_levels,num_requests,server_kwargs,gen_kwargs,prompt_words=200,max_attempts=5):
+    rows = []
+    for batch_size in batch_sizes:
+        for concurrency in concurrency_levels:
+            row = run_point(batch_size,concurrency,num_requests,server_kwargs,gen_kwargs,prompt_words,max_attempts)
+            print(f"batch_size {batch_size:>4} concurrency {concurrency:>4}  {row['rps']:8.1f} req/s  "
+                  f"p50 {row['p50_ms']:7.1f}ms  p95 {row['p95_ms']:7.1f}ms  p99 {row['p99_ms']:7.1f}ms  "
+                  f"utilisation {row['utilisation']:.2f}  failed {row['failed']}")
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test the rest client against a mock text-generation-inference server")
+    parser.add_argument("--batch_sizes",type=str,default="8,32",help="concurrent requests the mock server generates")
+    parser.add_argument("--concurrency",type=str,default="8,32,64",help="max_in_flight of the client")
+    parser.add_argument("--num_requests",type=int,default=500)
+    parser.add_argument("--prompt_words",type=int,default=200)
+    parser.add_argument("--max_new_tokens",type=int,default=64)
+    parser.add_argument("--max_attempts",type=int,default=5)
+    parser.add_argument("--latency",type=str,default="lognormal",help=", ".join(LATENCY_DISTRIBUTIONS))
+    parser.add_argument("--latency_mean",type=float,default=0.05)
+    parser.add_argument("--latency_sigma",type=float,default=0.5)
+    parser.add_argument("--tokens_per_second",type=float,default=200.0)
+    parser.add_argument("--output_tokens",type=int,default=16)
+    parser.add_argument("--error_rate",type=float,default=0.0)
+    parser.add_argument("--fail_rate",type=float,default=0.0)
+    parser.add_argument("--output",type=str,help="csv of the results")
+
+    args = parser.parse_args()
+    server_kwargs = dict(latency=args.latency,latency_mean=args.latency_mean,latency_sigma=args.latency_sigma,
+                         tokens_per_second=args.tokens_per_second,output_tokens=args.output_tokens,
+                         error_rate=args.error_rate,fail_rate=args.fail_rate)
+    gen_kwargs = dict(max_new_tokens=args.max_new_tokens,stop_sequences=["Stop Here"],seed=42)
+    results_df = run_benchmark([int(size) for size in args.batch_sizes.split(",")],
+                               [int(level) for level in args.concurrency.split(",")],
+                               args.num_requests,server_kwargs,gen_kwargs,args.prompt_words,args.max_attempts)
+    if args.output:
+        results_df.to_csv(args.output,index=False)
@@ -0,0 +1,84 @@
+import os,json,time,hashlib
+import sqlite3
+
+class GenerationCache:
+    """On-disk cache of generations keyed by a hash of (model, revision, backend, prompt, gen_kwargs).
+
+    Entries are evicted least recently used first once the cached text exceeds `max_bytes`.
+    """
+    def __init__(self,path,max_bytes=None,commit_every=256) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+
+        self.conn = sqlite3.connect(path,timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                          "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS generations_last_access ON generations (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size),0) FROM generations").fetchone()[0]
+
+    @staticmethod
+    def cacheable(gen_kwargs,backend):
+        # sampling without a seed gives a different answer on every call. TGI seeds every request, transformers
+        # seeds once per dataset so a sample's draw depends on what was generated before it
+        if not gen_kwargs.get("do_sample"):
+            return True
+        return backend == "tgi" and gen_kwargs.get("seed") is not None
+
+    @staticmethod
+    def make_key(model_id,revision,backend,prompt,gen_kwargs):
+        payload = json.dumps([model_id,revision,backend,prompt,gen_kwargs],sort_keys=True,default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self,key):
+        row = self.conn.execute("SELECT text FROM generations WHERE key = ?",(key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE generations SET last_access = ? WHERE key = ?",(time.time(),key))
+        self._maybe_commit()
+        return row[0]
+
+    def put(self,key,text):
+        size = len(text.encode("utf-8"))
+        previous = self.conn.execute("SELECT size FROM generations WHERE key = ?",(key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO generations (key,text,size,last_access) VALUES (?,?,?,?)",
+                          (key,text,size,time.time()))
+        self.size += size - (previous[0] if previous else 0)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.evict()
+        self._maybe_commit()
+
+    def evict(self):
+        # drop the least recently used tenth at a time until the cache is back under its limit
+        while self.size > self.max_bytes:
+            count = self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+            if count == 0:
+                break
+            rows = self.conn.execute("SELECT key,size FROM generations ORDER BY last_access LIMIT ?",
+                                     (max(1,count // 10),)).fetchall()
+            self.conn.executemany("DELETE FROM generations WHERE key = ?",[(key,) for key,_ in rows])
+            self.size -= sum(size for _,size in rows)
+
+    def _maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,"size_bytes":self.size}
+
+    def close(self):
+        self.commit()
+        self.conn.close()
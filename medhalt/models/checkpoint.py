@@ -0,0 +1,210 @@
+import os,re,json,csv,heapq,shutil,tempfile,itertools
+from medhalt.models.writer import PREDICTION_SUFFIXES,prediction_format,prediction_stem,parquet_parts,parquet_readable,read_records,write_records
+
+def prediction_folder(output_folder,model_path):
+    return os.path.join(output_folder,model_path.split("/")[1])
+
+def prediction_file(pred_folder,dataset_name,num_shards=1,shard_index=0,output_format="csv"):
+    suffix = PREDICTION_SUFFIXES[output_format]
+    if num_shards > 1:
+        return os.path.join(pred_folder,f"{dataset_name}.shard{shard_index}-of-{num_shards}{suffix}")
+    return os.path.join(pred_folder,f"{dataset_name}{suffix}")
+
+def manifest_path(pred_file):
+    return prediction_stem(pred_file) + ".manifest.json"
+
+def failed_path(pred_file):
+    return prediction_stem(pred_file) + ".failed.jsonl"
+
+def deferred_path(pred_file):
+    return prediction_stem(pred_file) + ".deferred.jsonl"
+
+def write_deferred(pred_file,deferred,max_input_tokens):
+    # samples that do not fit the server, a later run with larger limits picks them up on resume
+    with open(deferred_path(pred_file),'w') as fp:
+        for _id,input_tokens in deferred:
+            fp.write(json.dumps({"id":_id,"input_tokens":input_tokens,"max_input_tokens":max_input_tokens}) + "\n")
+
+def read_manifest(pred_file):
+    path = manifest_path(pred_file)
+    if not os.path.exists(path):
+        return None
+    with open(path,'r') as fp:
+        return json.load(fp)
+
+def write_manifest(pred_file,manifest):
+    with open(manifest_path(pred_file),'w') as fp:
+        json.dump(manifest,fp,indent=2)
+
+def check_manifest(pred_file,manifest):
+    previous = read_manifest(pred_file)
+    if previous is None:
+        return None
+    # round trip so that tuples/lists and int/float keys compare the same way
+    current = json.loads(json.dumps(manifest))
+    for key in ["dataset_name","shots","prompt_version","gen_kwargs"]:
+        if previous.get(key) != current.get(key):
+            raise ValueError(f"Cannot resume {pred_file}: '{key}' changed from {previous.get(key)} to {current.get(key)}")
+    return previous
+
+def read_rows(pred_file):
+    with open(pred_file,'r',newline='') as f:
+        yield from csv.reader(f)
+
+ROW_SPECIALS = re.compile(rb'["\n]')
+
+def block_row_end(block,quoted):
+    # end of the last csv row of `block` when it starts inside the quotes of a text or at the start of a row, 0 when
+    # no row ends in it and None when csv.writer could not have written it: a quote opens a field, is doubled in it
+    # or closes it before a comma or the line end
+    if b'"' not in block:
+        return 0 if quoted else block.rfind(b"\n") + 1
+    end = 0
+    escaped = -1
+    for match in ROW_SPECIALS.finditer(block):
+        at = match.start()
+        if at == escaped:
+            continue
+        if block[at:at + 1] == b"\n":
+            if not quoted:
+                end = at + 1
+        elif not quoted:
+            if at > 0 and block[at - 1:at] not in (b",",b"\n"):
+                return None
+            quoted = True
+        elif block[at + 1:at + 2] == b'"':
+            escaped = at + 1
+        elif block[at + 1:at + 2] in (b",",b"\r",b"\n",b""):
+            quoted = False
+        else:
+            return None
+    return end
+
+def parsed_row_end(pred_file):
+    # byte offset after the last complete csv row, a row spans several lines when its text has newlines and is torn
+    # when the file ends inside its quotes or before its line end
+    end = consumed = 0
+    line = b""
+    eof = False
+    with open(pred_file,'rb') as f:
+
+        def lines():
+            nonlocal consumed,line,eof
+            for line in f:
+                consumed += len(line)
+                yield line.decode('utf-8',errors='replace')
+            eof = True
+
+        for _ in csv.reader(lines()):
+            if not eof and line.endswith(b"\n"):
+                end = consumed
+    return end
+
+def last_row_end(pred_file,window=1 << 16):
+    # parses a window at the end of the file that starts after a newline, which ends a row or is inside the quotes of
+    # a text. Both are tried and the window doubles until they agree on the last row end, a row without an end can't
+    # span two fields of the csv field size limit. The whole file is parsed once the window covers it
+    with open(pred_file,'rb') as f:
+        size = f.seek(0,os.SEEK_END)
+        while window < size:
+            f.seek(size - window)
+            block = f.read(window)
+            window *= 2
+            if b"\n" not in block:
+                continue
+            block = block[block.index(b"\n") + 1:]
+            found = {end for end in (block_row_end(block,False),block_row_end(block,True)) if end is not None}
+            if not found:
+                break
+            if 0 in found and len(block) <= 8 * csv.field_size_limit():
+                continue
+            found.discard(0)
+            if len(found) == 1:
+                return size - len(block) + found.pop()
+    return parsed_row_end(pred_file)
+
+def last_line_end(f):
+    # json lines never span lines, everything after the last newline is the partial record
+    end = f.seek(0,os.SEEK_END)
+    while end > 0:
+        start = max(0,end - (1 << 16))
+        f.seek(start)
+        block = f.read(end - start)
+        if b"\n" in block:
+            return start + block.rindex(b"\n") + 1
+        end = start
+    return 0
+
+def drop_partial_rows(pred_file):
+    # the run died in the middle of a row or a parquet part, drop it so it gets regenerated
+    output_format = prediction_format(pred_file)
+    if output_format == "parquet":
+        for part in parquet_parts(pred_file):
+            if not parquet_readable(part):
+                print(f"Dropping unreadable {part}")
+                os.remove(part)
+        return
+    with open(pred_file,'rb+') as f:
+        # a newline at the end of a csv file can be one inside the quotes of a torn row, only parsing tells
+        end = last_row_end(pred_file) if output_format == "csv" else last_line_end(f)
+        if end < f.seek(0,os.SEEK_END):
+            f.truncate(end)
+
+def completed_ids(pred_file):
+    if not os.path.exists(pred_file) or (os.path.isfile(pred_file) and os.path.getsize(pred_file) == 0):
+        return set()
+
+    drop_partial_rows(pred_file)
+    if prediction_format(pred_file) == "csv":
+        return {row[0] for row in read_rows(pred_file) if len(row) == 2 and row[0] != "error"}
+    return {record["id"] for record in read_records(pred_file)}
+
+def sorted_runs(pred_files,position,folder,run_rows):
+    # the records of `pred_files` in runs of `run_rows`, each sorted and spilled to a json lines file, only one run
+    # is held in memory. The sequence number keeps records of unknown ids in their order
+    records = (record for pred_file in pred_files for record in read_records(pred_file))
+    keyed = ((position.get(record["id"],len(position)),sequence,record) for sequence,record in enumerate(records))
+    runs = []
+    for run in iter(lambda: sorted(itertools.islice(keyed,run_rows),key=lambda item: item[:2]),[]):
+        path = os.path.join(folder,f"run{len(runs)}.jsonl")
+        with open(path,'w') as f:
+            f.writelines(json.dumps(item) + "\n" for item in run)
+        runs.append(path)
+    return runs
+
+def read_run(path):
+    with open(path,'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+def merge_sorted(pred_files,pred_file,ids,run_rows=65536):
+    """Writes the records of `pred_files` to `pred_file` in the order of `ids`, unknown ids keep their order at the
+    end. An external sort: sorted runs are spilled next to `pred_file` and k-way merged, memory does not grow with
+    the number of predictions."""
+    position = {str(_id):index for index,_id in enumerate(ids)}
+    folder = tempfile.mkdtemp(dir=os.path.dirname(pred_file) or ".",prefix=".sort-")
+    try:
+        runs = sorted_runs(pred_files,position,folder,run_rows)
+        merged = heapq.merge(*[read_run(run) for run in runs],key=lambda item: item[:2])
+        write_records(pred_file,(item[2] for item in merged))
+    finally:
+        shutil.rmtree(folder)
+
+def sort_predictions(pred_file,ids):
+    # rewrite the prediction file in dataset order, unknown ids keep their relative order at the end
+    merge_sorted([pred_file],pred_file,ids)
+
+def merge_predictions(shard_files,pred_file,ids):
+    # shard rows are added to what <dataset>.csv already holds, then everything is put in dataset order
+    merge_sorted(([pred_file] if os.path.exists(pred_file) else []) + list(shard_files),pred_file,ids)
+
+    manifest = read_manifest(shard_files[0])
+    if manifest is not None:
+        write_manifest(pred_file,manifest)
+    for shard_file in shard_files:
+        if os.path.isdir(shard_file):
+            shutil.rmtree(shard_file)
+        else:
+            os.remove(shard_file)
+        if os.path.exists(manifest_path(shard_file)):
+            os.remove(manifest_path(shard_file))
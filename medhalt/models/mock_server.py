@@ -0,0 +1,200 @@
+import time
+import math
+import random
+import asyncio
+import threading
+from aiohttp import web
+
+# stands in for a text-generation-inference server: same /generate request and response, with a configurable
+# service time instead of a model so the client can be load tested on a cpu only machine
+
+LATENCY_DISTRIBUTIONS = ["constant","uniform","exponential","lognormal"]
+DEFAULT_TEXT = "{'cop': 'I do not know'}Stop Here"
+
+
+class MockServerStats:
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.generated_tokens = 0
+        self.busy_time = 0.0
+        self.queue_time = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def snapshot(self,max_batch_size):
+        elapsed = time.perf_counter() - self.started
+        return {"requests":self.requests,"errors":self.errors,"generated_tokens":self.generated_tokens,
+                "elapsed":elapsed,"busy_time":self.busy_time,"queue_time":self.queue_time,
+                "max_in_flight":self.max_in_flight,
+                # share of the batch slots that were generating
+                "utilisation":self.busy_time / (max_batch_size * elapsed) if elapsed > 0 else 0.0}
+
+
+class MockTGIServer:
+    """In-process stand in for a text-generation-inference `/generate` endpoint.
+
+    At most `max_batch_size` requests are served at once, the others wait for a slot. A request takes a prefill time
+    drawn from `latency` (one of LATENCY_DISTRIBUTIONS, with mean `latency_mean` seconds) plus its new tokens at
+    `tokens_per_second`. `error_rate` of the requests get a 503 overloaded error, which clients retry, and
+    `fail_rate` a 422 validation error, which they do not. Prompts longer than `max_input_length` whitespace
+    separated words are rejected like the real server does.
+    """
+
+    def __init__(self,max_batch_size=32,latency="lognormal",latency_mean=0.05,latency_sigma=0.5,tokens_per_second=200.0,
+                 output_tokens=16,error_rate=0.0,fail_rate=0.0,max_input_length=None,text=DEFAULT_TEXT,seed=0) -> None:
+        assert latency in LATENCY_DISTRIBUTIONS, f"latency has to be one of {LATENCY_DISTRIBUTIONS}"
+        self.max_batch_size = max_batch_size
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.max_input_length = max_input_length
+        self.text = text
+        self.random = random.Random(seed)
+        self.stats = MockServerStats()
+        self._slots = None
+        self._thread = None
+        self._loop = None
+        self._runner = None
+        self.url = None
+
+    def prefill_time(self):
+        mean = self.latency_mean
+        if self.latency == "constant":
+            return mean
+        if self.latency == "uniform":
+            return self.random.uniform(0,2 * mean)
+        if self.latency == "exponential":
+            return self.random.expovariate(1 / mean) if mean > 0 else 0.0
+        # lognormal with the requested mean
+        sigma = self.latency_sigma
+        return self.random.lognormvariate(0,sigma) * mean / math.exp(sigma ** 2 / 2)
+
+    @staticmethod
+    def error(status,message,error_type):
+        return web.json_response({"error":message,"error_type":error_type},status=status)
+
+    def response(self,new_tokens,seed):
+        tokens = [{"id":index,"text":" ","logprob":0.0,"special":False} for index in range(new_tokens)]
+        details = {"finish_reason":"length" if new_tokens < self.output_tokens else "stop_sequence",
+                   "generated_tokens":new_tokens,"seed":seed,"prefill":[],"tokens":tokens}
+        return {"generated_text":self.text,"details":details}
+
+    async def generate(self,request):
+        payload = await request.json()
+        parameters = payload.get("parameters") or {}
+        stats = self.stats
+        stats.requests += 1
+        if self.max_input_length is not None and len(payload.get("inputs","").split()) > self.max_input_length:
+            stats.errors += 1
+            return self.error(422,f"`inputs` must have less than {self.max_input_length} tokens","validation")
+        draw = self.random.random()
+        if draw < self.error_rate:
+            stats.errors += 1
+            return self.error(503,"Model is overloaded","overloaded")
+        if draw < self.error_rate + self.fail_rate:
+            stats.errors += 1
+            return self.error(422,"Input validation error","validation")
+
+        queued = time.perf_counter()
+        async with self._slots:
+            started = time.perf_counter()
+            stats.queue_time += started - queued
+            stats.in_flight += 1
+            stats.max_in_flight = max(stats.max_in_flight,stats.in_flight)
+            new_tokens = min(parameters.get("max_new_tokens") or 20,self.output_tokens)
+            try:
+                await asyncio.sleep(self.prefill_time() + new_tokens / self.tokens_per_second)
+            finally:
+                stats.in_flight -= 1
+                stats.busy_time += time.perf_counter() - started
+        stats.generated_tokens += new_tokens
+        return web.json_response(self.response(new_tokens,parameters.get("seed")))
+
+    async def metrics(self,request):
+        return web.json_response(self.stats.snapshot(self.max_batch_size))
+
+    async def health(self,request):
+        return web.Response(status=200)
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([web.post("/generate",self.generate),web.get("/metrics",self.metrics),web.get("/health",self.health)])
+        return app
+
+    async def _start(self,host,port):
+        self._slots = asyncio.Semaphore(self.max_batch_size)
+        self._runner = web.AppRunner(self.app(),access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner,host,port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}/generate"
+
+    def start(self,host="127.0.0.1",port=0):
+        """Serves from a background thread, returns the url of the /generate endpoint. Port 0 picks a free port."""
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start(host,port))
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve,daemon=True)
+        self._thread.start()
+        ready.wait()
+        self.stats.reset()
+        return self.url
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a mock text-generation-inference /generate endpoint")
+    parser.add_argument("--host",type=str,default="127.0.0.1")
+    parser.add_argument("--port",type=int,default=8082)
+    parser.add_argument("--max_batch_size",type=int,default=32)
+    parser.add_argument("--latency",type=str,default="lognormal",help=", ".join(LATENCY_DISTRIBUTIONS))
+    parser.add_argument("--latency_mean",type=float,default=0.05,help="mean prefill time in seconds")
+    parser.add_argument("--latency_sigma",type=float,default=0.5)
+    parser.add_argument("--tokens_per_second",type=float,default=200.0,help="per request decoding speed")
+    parser.add_argument("--output_tokens",type=int,default=16)
+    parser.add_argument("--error_rate",type=float,default=0.0,help="share of 503 overloaded responses")
+    parser.add_argument("--fail_rate",type=float,default=0.0,help="share of 422 validation errors")
+    parser.add_argument("--max_input_length",type=int)
+
+    args = parser.parse_args()
+    server = MockTGIServer(args.max_batch_size,args.latency,args.latency_mean,args.latency_sigma,args.tokens_per_second,
+                           args.output_tokens,args.error_rate,args.fail_rate,args.max_input_length)
+    server.start(args.host,args.port)
+    print(f"Serving {server.url}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,23 +1,104 @@
-import os,json,time
+import os,json,time,copy
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 from functools import partial
 import torch
-from medhalt.models.utils import PromptDataset
-import asyncio
-from transformers import AutoTokenizer,AutoModelForCausalLM
-from text_generation import AsyncClient
-import csv
+from medhalt.models.utils import PromptDataset,TokenBudgetBatchSampler,StopSequenceCriteria,truncate_at_stop
+from transformers import AutoTokenizer,AutoModelForCausalLM,StoppingCriteriaList,BitsAndBytesConfig
+from medhalt.models.scheduler import RestScheduler,schedule_tasks
+from medhalt.models.cache import GenerationCache
+from medhalt.models.telemetry import Telemetry
+from medhalt.models.checkpoint import check_manifest,write_manifest,completed_ids,failed_path,sort_predictions,prediction_folder,prediction_file,write_deferred
+from medhalt.models.writer import PredictionWriter
+
+TGI_ONLY_KWARGS = ["truncate","watermark","best_of","details","decoder_input_details","return_full_text"]
+
+def task_samples(dataset_name,dataset):
+    for index in range(len(dataset)):
+        sample = dataset[index]
+        yield sample["prompt"],(dataset_name,sample["id"])
+
+def budgeted_samples(dataset_name,requests):
+    for prompt,_id,budget in requests:
+        yield prompt,(dataset_name,_id),budget
+
+class RestOutput:
+    
+    def __init__(self,pred_file,total,desc=None,position=None,on_generated=None,telemetry=None,dataset_name=None,writer_kwargs=None) -> None:
+        self.pred_file = pred_file
+        self.on_generated = on_generated
+        self.telemetry = telemetry
+        self.dataset_name = dataset_name
+        if telemetry is not None:
+            telemetry.start(dataset_name)
+        # only the requests in flight have an entry
+        self.latency = {}
+        self.failed = 0
+        self.writer = PredictionWriter(pred_file,**(writer_kwargs or {}))
+        self.dead_letter = open(failed_path(pred_file),'w')
+        self.progress = tqdm(total=total,desc=desc,position=position)
+    
+    def on_request(self,_id,seconds,attempts,in_flight):
+        self.latency[_id] = seconds
+        if self.telemetry is not None:
+            self.telemetry.observe_request(self.dataset_name,seconds,attempts,in_flight)
+    
+    def on_result(self,_id,response):
+        details = response.details
+        latency = self.latency.pop(_id,None)
+        generated_tokens = details.generated_tokens if details else None
+        # the prompt tokens are only returned with decoder_input_details
+        input_tokens = len(details.prefill) if details and details.prefill else None
+        # the writer thread does the file system work, this only waits when its queue is full
+        write_seconds = self.writer.write(_id,response.generated_text,input_tokens,generated_tokens,latency)
+        if self.on_generated is not None:
+            self.on_generated(_id,response.generated_text)
+        if self.telemetry is not None:
+            finish_reason = getattr(details.finish_reason,"value",details.finish_reason) if details else None
+            self.telemetry.observe_result(self.dataset_name,latency,generated_tokens,finish_reason,write_seconds)
+        self.progress.update(1)
+    
+    def on_error(self,_id,error,attempts):
+        self.failed += 1
+        self.latency.pop(_id,None)
+        if self.telemetry is not None:
+            self.telemetry.observe_error(self.dataset_name,error)
+        self.dead_letter.write(json.dumps({"id":_id,"error":str(error),"error_type":type(error).__name__,"attempts":attempts}) + "\n")
+        self.dead_letter.flush()
+        self.progress.update(1)
+    
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            self.dead_letter.close()
+            self.progress.close()
+        if self.failed:
+            print(f"{self.failed} samples failed, see {failed_path(self.pred_file)}")
+        if self.telemetry is not None:
+            self.telemetry.summary(self.dataset_name)
 
 class Model:
     
-    def __init__(self,model_id_or_path,revision=None,load_in_8bit=False,load_in_4bit=False,rest_client=None) -> None:
+    def __init__(self,model_id_or_path,revision=None,load_in_8bit=False,load_in_4bit=False,rest_client=None,max_in_flight=64,max_attempts=5,backoff_base=1.0,device=None,
+                 cache_path=None,cache_max_mb=None,token_budget=None,max_tokens_in_flight=None,telemetry=None,output_format="csv",
+                 flush_rows=256,flush_seconds=5.0,fsync=False) -> None:
         
         self.rest_client = rest_client
+        self.output_format = output_format
+        self.writer_kwargs = dict(flush_rows=flush_rows,flush_seconds=flush_seconds,fsync=fsync)
+        self.token_budget = token_budget
+        self.telemetry = telemetry
         self.model_path = model_id_or_path
+        self.revision = revision
+        self.generation_cache = None
+        if cache_path:
+            self.generation_cache = GenerationCache(cache_path,max_bytes=int(cache_max_mb * 2**20) if cache_max_mb else None)
         
         if rest_client:
-            self.client = AsyncClient(rest_client)
+            self.scheduler = RestScheduler(rest_client,max_in_flight=max_in_flight,
+                                           max_attempts=max_attempts,backoff_base=backoff_base,
+                                           max_tokens_in_flight=max_tokens_in_flight)
         else:
             self.tokenizer = AutoTokenizer.from_pretrained(
                 model_id_or_path,
@@ -25,17 +106,24 @@ class Model:
                 padding_side="left",
                 truncation_side="left",
             )
+            # a single device holds a full replica, otherwise the model is sharded over all gpus
+            on_cpu = device is not None and torch.device(device).type == "cpu"
+            quantized = load_in_8bit or load_in_4bit
+            # from_pretrained no longer takes load_in_8bit/load_in_4bit, they go through a quantization config
+            quantization_kwargs = {}
+            if quantized:
+                quantization_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=load_in_8bit,load_in_4bit=load_in_4bit)
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_id_or_path,
                 revision=revision,
-                torch_dtype=torch.float16,
-                load_in_8bit=load_in_8bit,
-                device_map="balanced_low_0",
+                dtype=torch.float32 if on_cpu else torch.float16,
+                device_map={"":device} if device is not None else "balanced_low_0",
                 trust_remote_code=True,
+                **quantization_kwargs,
             )
         
             
-            if not load_in_8bit:
+            if not quantized and not on_cpu:
                 self.model.half()
             
             self.model.eval()
@@ -43,62 +131,238 @@ class Model:
             
             if self.tokenizer.pad_token_id is None:
                 self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+            
+            self._prefix_cache = None
     
-    async def rest_batch_generate(self,batch_inputs,**gen_kwargs):
-        async_calls = [self.client.generate(prompt,**gen_kwargs) for prompt,_ in zip(*batch_inputs)] 
-        ids = [_id for _,_id in zip(*batch_inputs)]
-        results = await asyncio.gather(*async_calls)
-        return results,ids
-        
-    def batch_generate(self,batch_input,**gen_kwargs):
+    def prefix_cache(self,prefix):
+        # the instruction and shots are shared by every sample of a task, run them through the model once
+        if self._prefix_cache is None or self._prefix_cache[0] != prefix:
+            self._prefix_cache = None
+            prefix_ids = self.tokenizer(prefix,add_special_tokens=False,return_tensors="pt")["input_ids"].to(self.model.device)
+            with torch.no_grad():
+                past_key_values = self.model(input_ids=prefix_ids,use_cache=True).past_key_values
+            self._prefix_cache = (prefix,prefix_ids,past_key_values)
+        return self._prefix_cache[1:]
+    
+    def with_prefix(self,batch_input,prefix):
+        prefix_ids,past_key_values = self.prefix_cache(prefix)
+        assert batch_input["prefix_length"] == prefix_ids.shape[1], "batch was split at a different prefix length"
+        batch_size = batch_input["input_ids"].shape[0]
+        batch_input["input_ids"] = torch.cat([prefix_ids.expand(batch_size,-1),batch_input["input_ids"]],dim=1)
+        batch_input["attention_mask"] = torch.cat([torch.ones_like(prefix_ids).expand(batch_size,-1),
+                                                   batch_input["attention_mask"]],dim=1)
+        if isinstance(past_key_values,tuple):
+            return tuple(tuple(state.expand(batch_size,*state.shape[1:]) for state in layer)
+                         for layer in past_key_values)
+        # Cache objects are extended in place by generate, every batch gets its own copy
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+    
+    def batch_generate(self,batch_input,prefix=None,stop_sequences=None,**gen_kwargs):
         with torch.no_grad():
             for key in batch_input:
                 if torch.is_tensor(batch_input[key]):
-                    batch_input[key] = batch_input[key].to("cuda:0")
-            generated_tokens =self.model.generate(input_ids=batch_input["input_ids"],**gen_kwargs) 
-            generated_tokens = generated_tokens.cpu().numpy()
+                    batch_input[key] = batch_input[key].to(self.model.device)
+            if prefix is not None and batch_input.get("prefix_length") is not None:
+                # the inputs hold only the sample suffixes, generate continues from the cached prefix
+                gen_kwargs["past_key_values"] = self.with_prefix(batch_input,prefix)
+            prompt_length = batch_input["input_ids"].shape[1]
+            if stop_sequences:
+                gen_kwargs["stopping_criteria"] = StoppingCriteriaList([StopSequenceCriteria(self.tokenizer,stop_sequences,prompt_length)])
+            generated_tokens =self.model.generate(input_ids=batch_input["input_ids"],
+                                                  attention_mask=batch_input["attention_mask"],
+                                                  pad_token_id=self.tokenizer.pad_token_id,
+                                                  **gen_kwargs) 
+            generated_tokens = generated_tokens[:,prompt_length:].cpu().numpy()
+            self.last_generated_tokens = (generated_tokens != self.tokenizer.pad_token_id).sum(axis=1)
             generated_text = self.tokenizer.batch_decode(generated_tokens,
                                                     skip_special_tokens=True,
                                                     clean_up_tokenization_spaces=True)
-        return generated_text
+        if stop_sequences:
+            generated_text = [truncate_at_stop(text,stop_sequences) for text in generated_text]
+        return generated_text,batch_input["ids"]
+    
+    def serve_from_cache(self,dataset,pred_file,gen_kwargs):
+        """Writes cached generations to `pred_file`, drops them from `dataset` and returns the cache keys of the rest."""
+        backend = "tgi" if self.rest_client else "transformers"
+        if self.generation_cache is None or not GenerationCache.cacheable(gen_kwargs,backend):
+            return None
+        cache_keys,hits = {},[]
+        for index in range(len(dataset)):
+            sample = dataset[index]
+            key = GenerationCache.make_key(self.model_path,self.revision,backend,sample["prompt"],gen_kwargs)
+            text = self.generation_cache.get(key)
+            if text is None:
+                cache_keys[str(sample["id"])] = key
+            else:
+                hits.append([sample["id"],text])
+        
+        if hits:
+            with PredictionWriter(pred_file,**self.writer_kwargs) as writer:
+                for _id,text in hits:
+                    writer.write(_id,text)
+            dataset.drop({str(_id) for _id,_ in hits})
+        print(f"Generation cache - {len(hits)} hits, {len(cache_keys)} misses")
+        return cache_keys
+    
+    def cache_generation(self,cache_keys,_id,text):
+        if cache_keys is not None and str(_id) in cache_keys:
+            self.generation_cache.put(cache_keys[str(_id)],text)
     
-    def run_generation(self,dataset_name,prompt_template_fn,batch_size=16,output_folder=None,**gen_kwargs):
-        outputs = []
-        dataset = PromptDataset(dataset_name,prompt_template_fn)
+    def plan_requests(self,dataset,pred_file,cache_keys,gen_kwargs):
+        """Fits the prompts of `dataset` into the token budget, returns [(prompt,id,budget)]. Samples that cannot be
+        sent go to the deferred file, prompts or max_new_tokens changed to fit are not cached."""
+        requests,deferred = self.token_budget.plan(dataset,gen_kwargs.get("max_new_tokens"))
+        write_deferred(pred_file,deferred,self.token_budget.max_input_tokens)
+        modified = 0
+        for _,_id,budget in requests:
+            if budget["modified"]:
+                modified += 1
+                if cache_keys is not None:
+                    cache_keys.pop(str(_id),None)
+        print(f"Token budget - {len(requests)} requests ({modified} fitted), {len(deferred)} deferred")
+        return requests
+    
+    def rest_generate(self,dataset,pred_file,cache_keys=None,**gen_kwargs):
+        samples = (dataset[i] for i in range(len(dataset)))
+        requests,total = ((s["prompt"],s["id"]) for s in samples),len(dataset)
+        if self.token_budget is not None:
+            requests = self.plan_requests(dataset,pred_file,cache_keys,gen_kwargs)
+            total = len(requests)
+        output = RestOutput(pred_file,total,on_generated=partial(self.cache_generation,cache_keys),
+                            telemetry=self.telemetry,dataset_name=dataset.dataset_name,writer_kwargs=self.writer_kwargs)
+        try:
+            self.scheduler.run(requests,gen_kwargs,output.on_result,output.on_error,output.on_request)
+        finally:
+            output.close()
+    
+    def local_generate(self,dataset,pred_file,batch_size,max_batch_tokens=None,prefix_cache=False,cache_keys=None,**gen_kwargs):
+        if len(dataset) == 0:
+            # everything was resumed or served from the cache
+            return
+        gen_kwargs = dict(gen_kwargs)
+        # text-generation-inference parameters that have no transformers generate() equivalent
+        seed = gen_kwargs.pop("seed",None)
+        for key in TGI_ONLY_KWARGS:
+            gen_kwargs.pop(key,None)
+        if seed is not None:
+            torch.manual_seed(seed)
+        if self.telemetry is not None:
+            self.telemetry.start(dataset.dataset_name)
         
-        if self.rest_client:
-            _collate_fn = dataset._restclient_collate_fn   
-            _collate_fn = partial(_collate_fn)
+        prefix = dataset.instruction if prefix_cache else None
+        if prefix is not None:
+            _collate_fn = partial(dataset._prefix_collate_fn,
+                              self.tokenizer,prefix,self.prefix_cache(prefix)[0][0].tolist())
         else:
             _collate_fn = dataset._collate_fn
             _collate_fn = partial(_collate_fn,
                               self.tokenizer)
-            
-        dataloader = DataLoader(dataset,batch_size,collate_fn=_collate_fn)
-        pred_folder = os.path.join(output_folder,self.model_path.split("/")[1])
+        if max_batch_tokens:
+            lengths = [length + gen_kwargs.get("max_new_tokens",0) for length in dataset.token_lengths(self.tokenizer)]
+            batch_sampler = TokenBudgetBatchSampler(lengths,max_batch_tokens,max_batch_size=batch_size)
+            dataloader = DataLoader(dataset,batch_sampler=batch_sampler,collate_fn=_collate_fn)
+        else:
+            dataloader = DataLoader(dataset,batch_size,collate_fn=_collate_fn)
+        
+        with PredictionWriter(pred_file,**self.writer_kwargs) as writer:
+            for batch in tqdm(dataloader):
+                started = time.perf_counter()
+                generated_texts,ids = self.batch_generate(batch,prefix=prefix,**gen_kwargs)
+                generated = time.perf_counter()
+                # after batch_generate the attention mask also covers the cached prefix
+                input_tokens = batch["attention_mask"].sum(dim=1).tolist()
+                write_seconds = 0.0
+                for gtext,_id,sample_input_tokens,sample_generated_tokens in zip(generated_texts,ids,input_tokens,self.last_generated_tokens):
+                    write_seconds += writer.write(_id,gtext,sample_input_tokens,sample_generated_tokens,generated - started)
+                    self.cache_generation(cache_keys,_id,gtext)
+                if self.telemetry is not None:
+                    self.telemetry.observe_batch(dataset.dataset_name,len(ids),generated - started,
+                                                 write_seconds,int(self.last_generated_tokens.sum()))
+        
+        if self.telemetry is not None:
+            self.telemetry.summary(dataset.dataset_name)
+        if max_batch_tokens:
+            # batches ran in length order, restore the dataset order
+            sort_predictions(pred_file,dataset.ids)
+    
+    def prepare_dataset(self,dataset_name,prompt_template_fn,output_folder,gen_kwargs,resume=False,shots=2,prompt_version='v0',
+                        instruction=None,skip_ids=None,num_shards=1,shard_index=0,prompt_artifacts=None,prompt_seed=None):
+        pred_folder = prediction_folder(output_folder,self.model_path)
         os.makedirs(pred_folder,exist_ok=True)
+        pred_file = prediction_file(pred_folder,dataset_name,num_shards,shard_index,self.output_format)
         
+        manifest = {"dataset_name":dataset_name,"shots":shots,"prompt_version":prompt_version,"prompt_seed":prompt_seed,
+                    "gen_kwargs":gen_kwargs}
+        skip_ids = set(skip_ids or [])
+        if resume:
+            previous = check_manifest(pred_file,manifest)
+            if previous is not None:
+                # reuse the recorded few-shot prefix so resumed samples see the same shots
+                instruction = previous.get("instruction")
+            skip_ids |= completed_ids(pred_file)
         
-        for batch in tqdm(dataloader):
-            if self.rest_client:
-                try:
-                    generated_texts,ids = asyncio.run(self.rest_batch_generate(batch,**gen_kwargs))
-                except Exception as e:
-                    generated_texts,ids = [f"error:{str(e)}"]*len(batch[0]),["error"]*len(batch[0])
-            else:
-                generated_texts,ids = self.batch_generate(batch,**gen_kwargs)
-            
-            with open(os.path.join(pred_folder,f"{dataset_name}.csv"), 'a') as f:
-                writer = csv.writer(f)
-                for gtext,_id in  zip(generated_texts,ids):
-                    writer.writerow([_id,gtext.generated_text])
-                    
-            outputs.append({"generated_text":[gtext.generated_text for gtext in generated_texts],"id":ids})
+        dataset = PromptDataset(dataset_name,prompt_template_fn,shots=shots,prompt_version=prompt_version,
+                                instruction=instruction,skip_ids=skip_ids,num_shards=num_shards,shard_index=shard_index,
+                                artifact_folder=prompt_artifacts,prompt_seed=prompt_seed)
+        manifest["instruction"] = dataset.instruction
+        write_manifest(pred_file,manifest)
+        
+        if resume:
+            print(f"Resuming {dataset_name} - {len(skip_ids)} completed, {len(dataset)} remaining")
         
         with open(os.path.join(pred_folder,"gen_kwargs.json"),'w') as fp:
             json.dump(gen_kwargs,fp)
-             
-        return outputs
+        return dataset,pred_file
+    
+    def run_generation(self,dataset_name,prompt_template_fn,batch_size=16,output_folder=None,max_batch_tokens=None,prefix_cache=False,resume=False,
+                       shots=2,prompt_version='v0',instruction=None,skip_ids=None,num_shards=1,shard_index=0,prompt_artifacts=None,
+                       prompt_seed=None,**gen_kwargs):
+        dataset,pred_file = self.prepare_dataset(dataset_name,prompt_template_fn,output_folder,gen_kwargs,resume=resume,shots=shots,
+                                                 prompt_version=prompt_version,instruction=instruction,skip_ids=skip_ids,
+                                                 num_shards=num_shards,shard_index=shard_index,prompt_artifacts=prompt_artifacts,
+                                                 prompt_seed=prompt_seed)
+        cache_keys = self.serve_from_cache(dataset,pred_file,gen_kwargs)
+        
+        try:
+            if self.rest_client:
+                self.rest_generate(dataset,pred_file,cache_keys=cache_keys,**gen_kwargs)
+            else:
+                self.local_generate(dataset,pred_file,batch_size,max_batch_tokens,prefix_cache,cache_keys=cache_keys,**gen_kwargs)
+        finally:
+            if self.generation_cache is not None:
+                self.generation_cache.commit()
+    
+    def run_multi_generation(self,dataset_names,prompt_template_fn,output_folder=None,task_weights=None,task_priority=None,
+                             resume=False,shots=2,prompt_version='v0',prompt_artifacts=None,prompt_seed=None,**gen_kwargs):
+        """Runs several datasets through one rest request queue so the server stays busy across task boundaries."""
+        assert self.rest_client, "concurrent tasks need a rest client"
+        outputs,streams = {},{}
+        try:
+            for position,dataset_name in enumerate(dataset_names):
+                dataset,pred_file = self.prepare_dataset(dataset_name,prompt_template_fn,output_folder,gen_kwargs,
+                                                         resume=resume,shots=shots,prompt_version=prompt_version,
+                                                         prompt_artifacts=prompt_artifacts,prompt_seed=prompt_seed)
+                cache_keys = self.serve_from_cache(dataset,pred_file,gen_kwargs)
+                streams[dataset_name],total = task_samples(dataset_name,dataset),len(dataset)
+                if self.token_budget is not None:
+                    requests = self.plan_requests(dataset,pred_file,cache_keys,gen_kwargs)
+                    streams[dataset_name],total = budgeted_samples(dataset_name,requests),len(requests)
+                outputs[dataset_name] = RestOutput(pred_file,total,desc=dataset_name,position=position,
+                                                   on_generated=partial(self.cache_generation,cache_keys),
+                                                   telemetry=self.telemetry,dataset_name=dataset_name,
+                                                   writer_kwargs=self.writer_kwargs)
+            
+            on_result = lambda key,response: outputs[key[0]].on_result(key[1],response)
+            on_error = lambda key,error,attempts: outputs[key[0]].on_error(key[1],error,attempts)
+            on_request = lambda key,seconds,attempts,in_flight: outputs[key[0]].on_request(key[1],seconds,attempts,in_flight)
+            self.scheduler.run(schedule_tasks(streams,task_weights,task_priority),gen_kwargs,on_result,on_error,on_request)
+        finally:
+            for output in outputs.values():
+                output.close()
+            if self.generation_cache is not None:
+                self.generation_cache.commit()
 
 if __name__ == "__main__":
     
@@ -114,38 +378,120 @@ if __name__ == "__main__":
     parser.add_argument("--temperature",type=float,default=0.2)
     parser.add_argument("--max_new_tokens",type=int,default=64)
     parser.add_argument("--batch_size",type=int,default=32)
+    parser.add_argument("--max_batch_tokens",type=int)
+    parser.add_argument("--prefix_cache",action="store_true")
     parser.add_argument("--top_p",type=float,default=0.95)
     #parser.add_argument("--top_k",type=float,default=0)
     parser.add_argument("--rest_client",type=str)
+    parser.add_argument("--max_in_flight",type=int,default=64)
+    parser.add_argument("--max_attempts",type=int,default=5)
+    parser.add_argument("--backoff_base",type=float,default=1.0)
     parser.add_argument("--output_folder",type=str)
+    parser.add_argument("--resume",action="store_true")
+    parser.add_argument("--cache_path",type=str,help="sqlite file caching generations across runs")
+    parser.add_argument("--cache_max_mb",type=float)
+    parser.add_argument("--concurrent_tasks",action="store_true",help="feed all datasets through one rest request queue")
+    parser.add_argument("--task_weights",type=str,help="share of the request queue per dataset, e.g. FCT=4,Nota=2")
+    parser.add_argument("--task_priority",type=str,help="datasets drained first, in order, e.g. FCT,Nota")
+    parser.add_argument("--num_workers",type=int,default=1)
+    parser.add_argument("--devices",type=str,help="comma separated devices for the worker replicas, e.g. cuda:0,cuda:1 or cpu")
+    parser.add_argument("--prompt_artifacts",type=str,help="folder of prompts compiled with medhalt.prompts.artifacts")
+    parser.add_argument("--prompt_seed",type=int,default=42,help="seed of the few-shot selection, also picks the compiled prompts to load")
+    parser.add_argument("--tokenizer",type=str,help="tokenizer of the token budget, defaults to --model_path")
+    parser.add_argument("--max_input_tokens",type=int,help="--max-input-length of the server, prompts are fitted before they are sent")
+    parser.add_argument("--max_total_tokens",type=int,help="--max-total-tokens of the server, caps max_new_tokens per request")
+    parser.add_argument("--overflow",type=str,default="truncate",help="prompts over --max_input_tokens: truncate, shots or defer")
+    parser.add_argument("--max_tokens_in_flight",type=int,help="prompt and new tokens of the open requests")
+    parser.add_argument("--telemetry_path",type=str,help="metrics file, prometheus textfile format unless it ends with .json")
+    parser.add_argument("--telemetry_interval",type=float,default=15.0,help="seconds between metrics file updates")
+    parser.add_argument("--output_format",type=str,default="csv",choices=["csv","jsonl","parquet"],
+                        help="jsonl and parquet also keep token counts and timings of every sample")
+    parser.add_argument("--flush_rows",type=int,default=256,help="predictions buffered by the writer thread before a write")
+    parser.add_argument("--flush_seconds",type=float,default=5.0,help="longest time a prediction stays buffered")
+    parser.add_argument("--fsync",action="store_true",help="fsync the predictions after every flush")
 
     
     
     args = parser.parse_args()
     
-    model_cls = Model(model_id_or_path=args.model_path,
-                      load_in_8bit=args.load_in_8bit,
-                      load_in_4bit=args.load_in_4bit,
-                      rest_client=args.rest_client)
+    model_kwargs = dict(model_id_or_path=args.model_path,
+                        load_in_8bit=args.load_in_8bit,
+                        load_in_4bit=args.load_in_4bit,
+                        cache_path=args.cache_path,
+                        cache_max_mb=args.cache_max_mb,
+                        output_format=args.output_format,
+                        flush_rows=args.flush_rows,
+                        flush_seconds=args.flush_seconds,
+                        fsync=args.fsync)
+    data_parallel = args.num_workers > 1 and not args.rest_client
+    
+    token_budget = None
+    if args.max_input_tokens and args.rest_client:
+        from transformers import AutoTokenizer
+        from medhalt.prompts.token_index import TokenBudget
+        tokenizer_name = args.tokenizer or args.model_path
+        token_budget = TokenBudget(AutoTokenizer.from_pretrained(tokenizer_name),tokenizer_name,args.max_input_tokens,
+                                   args.max_total_tokens,overflow=args.overflow)
+    
+    telemetry = Telemetry(args.telemetry_path,args.telemetry_interval)
+    
+    if not data_parallel:
+        model_cls = Model(rest_client=args.rest_client,
+                          telemetry=telemetry,
+                          max_in_flight=args.max_in_flight,
+                          max_attempts=args.max_attempts,
+                          backoff_base=args.backoff_base,
+                          token_budget=token_budget,
+                          max_tokens_in_flight=args.max_tokens_in_flight,
+                          **model_kwargs)
     
     prompt_template_fn = lambda row: row
+    ds_names = ["Nota","fake", "FCT","abs2pub", "pmid2title", "url2title", "title2pub"]
+    
+    if args.concurrent_tasks and args.rest_client:
+        task_weights = {name:float(weight) for name,weight in (item.split("=") for item in args.task_weights.split(","))} if args.task_weights else None
+        task_priority = args.task_priority.split(",") if args.task_priority else None
+        model_cls.run_multi_generation(ds_names,
+                                       prompt_template_fn,
+                                       output_folder=args.output_folder,
+                                       task_weights=task_weights,
+                                       task_priority=task_priority,
+                                       resume=args.resume,
+                                       prompt_artifacts=args.prompt_artifacts,
+                                       prompt_seed=args.prompt_seed,
+                                       temperature=args.temperature,
+                                       do_sample= not args.greedy,
+                                       max_new_tokens=args.max_new_tokens,
+                                       top_p=args.top_p,
+                                       stop_sequences=["Stop Here"],
+                                       seed=42)
+        ds_names = []
     
-    for ds_name in ["Nota","fake", "FCT","abs2pub", "pmid2title", "url2title", "title2pub"]:
+    for ds_name in ds_names:
         try:
             
             print(f"Running predictions for - {ds_name}")
-
-            generations = model_cls.run_generation(dataset_name=ds_name,
-                                                    prompt_template_fn=prompt_template_fn,
-                                                    batch_size=args.batch_size,
-                                                    temperature=args.temperature,
-                                                    do_sample= not args.greedy,
-                                                    max_new_tokens=args.max_new_tokens,
-                                                    top_p=args.top_p,
-                                                    output_folder=args.output_folder,
-                                                    stop_sequences=["Stop Here"],
-                                                    seed=42) 
+            
+            run_kwargs = dict(dataset_name=ds_name,
+                              batch_size=args.batch_size,
+                              max_batch_tokens=args.max_batch_tokens,
+                              prefix_cache=args.prefix_cache,
+                              temperature=args.temperature,
+                              do_sample= not args.greedy,
+                              max_new_tokens=args.max_new_tokens,
+                              top_p=args.top_p,
+                              output_folder=args.output_folder,
+                              resume=args.resume,
+                              prompt_artifacts=args.prompt_artifacts,
+                              prompt_seed=args.prompt_seed,
+                              stop_sequences=["Stop Here"],
+                              seed=42)
+            
+            if data_parallel:
+                from medhalt.models.parallel import run_data_parallel
+                devices = args.devices.split(",") if args.devices else None
+                run_data_parallel(model_kwargs,args.num_workers,devices,**run_kwargs)
+            else:
+                model_cls.run_generation(prompt_template_fn=prompt_template_fn,**run_kwargs)
         except Exception as e:
             print(e)
-
-
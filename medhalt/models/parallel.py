@@ -0,0 +1,54 @@
+import os
+import torch
+import torch.multiprocessing as mp
+from medhalt.models.model import Model
+from medhalt.models.checkpoint import (completed_ids,read_manifest,merge_predictions,
+                                       prediction_folder,prediction_file)
+from medhalt.prompts.utils import get_full_prompt,load_ids
+from medhalt.prompts.artifacts import PromptArtifact,artifact_path
+
+def identity(row):
+    return row
+
+def default_devices():
+    if torch.cuda.is_available():
+        return [f"cuda:{index}" for index in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+def _worker(shard_index,num_shards,devices,model_kwargs,run_kwargs):
+    device = devices[shard_index % len(devices)]
+    if torch.device(device).type == "cpu":
+        # replicas sharing the cpu split its cores instead of oversubscribing them
+        cpu_replicas = sum(1 for index in range(num_shards) if torch.device(devices[index % len(devices)]).type == "cpu")
+        torch.set_num_threads(max(1,(os.cpu_count() or 1) // cpu_replicas))
+    model = Model(device=device,**model_kwargs)
+    model.run_generation(prompt_template_fn=identity,num_shards=num_shards,shard_index=shard_index,**run_kwargs)
+
+def run_data_parallel(model_kwargs,num_workers,devices=None,dataset_name=None,output_folder=None,resume=False,
+                      shots=2,prompt_version='v0',prompt_artifacts=None,prompt_seed=None,**run_kwargs):
+    """Shards `dataset_name` over `num_workers` processes, each with its own model replica, then merges
+    the shard outputs into <dataset>.csv (or the jsonl/parquet predictions) in dataset order."""
+    devices = devices or default_devices()
+    output_format = model_kwargs.get("output_format","csv")
+    pred_folder = prediction_folder(output_folder,model_kwargs["model_id_or_path"])
+    pred_file = prediction_file(pred_folder,dataset_name,output_format=output_format)
+    shard_files = [prediction_file(pred_folder,dataset_name,num_workers,index,output_format) for index in range(num_workers)]
+
+    # every shard must see the same shots, so the prefix is rendered once here
+    instruction = None
+    skip_ids = set()
+    if resume:
+        manifest = read_manifest(pred_file)
+        instruction = manifest.get("instruction") if manifest else None
+        skip_ids = completed_ids(pred_file)
+    if instruction is None and prompt_artifacts is not None:
+        instruction = PromptArtifact(artifact_path(prompt_artifacts,dataset_name,shots,prompt_version,prompt_seed)).instruction
+    if instruction is None:
+        instruction = get_full_prompt(dataset_name,shots,prompt_version,prompt_seed)
+
+    run_kwargs.update(dataset_name=dataset_name,output_folder=output_folder,resume=resume,shots=shots,
+                      prompt_version=prompt_version,instruction=instruction,skip_ids=skip_ids,
+                      prompt_artifacts=prompt_artifacts,prompt_seed=prompt_seed)
+    mp.spawn(_worker,args=(num_workers,devices,model_kwargs,run_kwargs),nprocs=num_workers,join=True)
+
+    merge_predictions([shard_file for shard_file in shard_files if os.path.exists(shard_file)],pred_file,load_ids(dataset_name))
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import random
+import aiohttp
+from text_generation.types import Request,Parameters,Response
+from text_generation.errors import (parse_error,OverloadedError,RateLimitExceededError,
+                                    ShardNotReadyError,ShardTimeoutError)
+
+TRANSIENT_ERRORS = (asyncio.TimeoutError,aiohttp.ClientError,OverloadedError,RateLimitExceededError,
+                    ShardNotReadyError,ShardTimeoutError)
+TRANSIENT_STATUS = {429,502,503,504}
+
+def interleave(streams,weights=None):
+    # smooth weighted round robin, every stream gets a share of the queue proportional to its weight
+    streams = dict(streams)
+    weights = {name:(weights or {}).get(name,1) for name in streams}
+    current = {name:0 for name in streams}
+    while streams:
+        total = sum(weights[name] for name in streams)
+        for name in streams:
+            current[name] += weights[name]
+        name = max(streams,key=current.get)
+        current[name] -= total
+        try:
+            yield next(streams[name])
+        except StopIteration:
+            del streams[name],current[name]
+
+def schedule_tasks(streams,weights=None,priority=None):
+    """Merges per task (prompt,key) iterators into one, draining the `priority` tasks first, in order."""
+    priority = [name for name in (priority or []) if name in streams]
+    for name in priority:
+        yield from streams[name]
+    yield from interleave({name:stream for name,stream in streams.items() if name not in priority},weights)
+
+class TokenLimiter:
+    """Caps the tokens (prompt plus max_new_tokens) of the requests in flight, a request larger than the cap runs alone."""
+
+    def __init__(self,max_tokens) -> None:
+        self.max_tokens = max_tokens
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self,tokens):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + tokens <= self.max_tokens)
+            self.in_flight += tokens
+
+    async def release(self,tokens):
+        async with self.condition:
+            self.in_flight -= tokens
+            self.condition.notify_all()
+
+class RestScheduler:
+
+    def __init__(self,rest_client,max_in_flight=64,timeout=600,max_attempts=5,backoff_base=1.0,backoff_max=60.0,
+                 max_tokens_in_flight=None) -> None:
+
+        self.rest_client = rest_client
+        self.max_in_flight = max_in_flight
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.in_flight = 0
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    @staticmethod
+    def build_request(prompt,stop_sequences=None,**gen_kwargs):
+        # same payload as text_generation.AsyncClient.generate
+        parameters = Parameters(details=True,stop=stop_sequences if stop_sequences is not None else [],**gen_kwargs)
+        return Request(inputs=prompt,stream=False,parameters=parameters)
+
+    async def generate(self,session,prompt,**gen_kwargs):
+        request = self.build_request(prompt,**gen_kwargs)
+        async with session.post(self.rest_client,json=request.dict()) as resp:
+            payload = await resp.json()
+            if resp.status != 200:
+                error = parse_error(resp.status,payload)
+                error.status = resp.status
+                raise error
+        # older TGI versions wrap the response in a list
+        if isinstance(payload,list):
+            payload = payload[0]
+        return Response(**payload)
+
+    @staticmethod
+    def is_transient(error):
+        return isinstance(error,TRANSIENT_ERRORS) or getattr(error,"status",None) in TRANSIENT_STATUS
+
+    def backoff(self,attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0,min(self.backoff_max,self.backoff_base * 2 ** attempt))
+
+    async def _generate_with_retry(self,session,prompt,gen_kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await self.generate(session,prompt,**gen_kwargs),None,attempt
+            except Exception as e:
+                if attempt >= self.max_attempts or not self.is_transient(e):
+                    return None,e,attempt
+            await asyncio.sleep(self.backoff(attempt - 1))
+
+    @staticmethod
+    def request_load(budget,gen_kwargs):
+        if budget is None:
+            return 0
+        return budget["input_tokens"] + (budget["max_new_tokens"] or gen_kwargs.get("max_new_tokens") or 0)
+
+    async def _worker(self,session,samples,gen_kwargs,on_result,on_error,limiter,on_request):
+        # every worker holds one request in flight and pulls the next prompt as soon as it is done
+        for sample in samples:
+            prompt,key = sample[:2]
+            budget = sample[2] if len(sample) > 2 else None
+            request_kwargs = gen_kwargs
+            if budget is not None and budget["max_new_tokens"] is not None:
+                request_kwargs = dict(gen_kwargs,max_new_tokens=budget["max_new_tokens"])
+            load = self.request_load(budget,gen_kwargs)
+            if limiter is not None:
+                await limiter.acquire(load)
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                response,error,attempts = await self._generate_with_retry(session,prompt,request_kwargs)
+            finally:
+                self.in_flight -= 1
+                if limiter is not None:
+                    await limiter.release(load)
+            if on_request is not None:
+                on_request(key,time.perf_counter() - started,attempts,self.in_flight + 1)
+            if error is None:
+                on_result(key,response)
+            elif on_error is not None:
+                on_error(key,error,attempts)
+
+    async def _run(self,samples,gen_kwargs,on_result,on_error,on_request):
+        samples = iter(samples)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector,timeout=timeout) as session:
+            limiter = TokenLimiter(self.max_tokens_in_flight) if self.max_tokens_in_flight else None
+            workers = [self._worker(session,samples,gen_kwargs,on_result,on_error,limiter,on_request)
+                       for _ in range(self.max_in_flight)]
+            await asyncio.gather(*workers)
+
+    def run(self,samples,gen_kwargs,on_result,on_error=None,on_request=None):
+        """Generates `samples` ((prompt,key) pairs) keeping `max_in_flight` requests open on one connection pool.
+
+        A sample can carry a token budget as a third item ({"input_tokens","max_new_tokens"}, see
+        medhalt.prompts.token_index.TokenBudget): its max_new_tokens overrides the one of `gen_kwargs` and, with
+        `max_tokens_in_flight`, the requests open at once never add up to more prompt and new tokens than that.
+
+        `on_result(key,response)` is called on the event loop as each request completes. Timeouts, connection
+        errors and 429/5xx responses are retried with backoff; `on_error(key,error,attempts)` is called for
+        requests that still fail after `max_attempts` or fail with a non transient error.
+        `on_request(key,seconds,attempts,in_flight)` is called before either of them with the time the request took,
+        retries included, and the number of requests that were in flight with it.
+        """
+        asyncio.run(self._run(samples,gen_kwargs,on_result,on_error,on_request))
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import bisect
+import threading
+from collections import Counter,defaultdict
+
+LATENCY_BUCKETS = [0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120]
+TOKEN_BUCKETS = [1,2,4,8,16,32,64,128,256,512,1024]
+RATE_BUCKETS = [1,5,10,25,50,100,250,500,1000]
+WRITE_BUCKETS = [0.0001,0.0005,0.001,0.005,0.01,0.05,0.1,0.5,1]
+QUEUE_BUCKETS = [1,2,4,8,16,32,64,128,256]
+
+
+class Histogram:
+    """Prometheus style histogram, `counts[i]` holds the observations up to `buckets[i]` (not cumulative)."""
+
+    def __init__(self,buckets) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self,q):
+        # linear interpolation inside the bucket holding the quantile, like histogram_quantile in promql
+        if self.count == 0:
+            return float("nan")
+        rank = q * self.count
+        seen = 0
+        for index,count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        total,counts = 0,[]
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def to_dict(self):
+        return {"count":self.count,"sum":self.sum,"buckets":dict(zip([str(b) for b in self.buckets] + ["+Inf"],self.cumulative())),
+                "p50":self.quantile(0.5),"p95":self.quantile(0.95),"p99":self.quantile(0.99)}
+
+
+class DatasetMetrics:
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.generated_tokens = Histogram(TOKEN_BUCKETS)
+        self.tokens_per_second = Histogram(RATE_BUCKETS)
+        self.write_seconds = Histogram(WRITE_BUCKETS)
+        self.in_flight = Histogram(QUEUE_BUCKETS)
+        self.counters = Counter()
+        self.finish_reasons = Counter()
+        self.error_types = Counter()
+
+
+class Telemetry:
+    """Counters and histograms of the generation loop, per dataset.
+
+    Records request latency, generated tokens, tokens/sec, finish reasons, errors, retries, requests in flight and the
+    time spent writing predictions. Every `interval` seconds the metrics are written to `path`, as a Prometheus
+    textfile (for node_exporter's textfile collector) unless the path ends with `.json`.
+    """
+
+    def __init__(self,path=None,interval=15.0) -> None:
+        self.path = path
+        self.interval = interval
+        self.datasets = defaultdict(DatasetMetrics)
+        self.last_flush = time.monotonic()
+        # the rest client calls back from the event loop, local generation from the main thread
+        self.lock = threading.Lock()
+
+    def start(self,dataset):
+        # every run of a dataset starts from empty metrics, a resumed run does not report the previous one
+        with self.lock:
+            self.datasets[dataset] = DatasetMetrics()
+
+    def observe_request(self,dataset,latency,attempts,in_flight):
+        with self.lock:
+            metrics = self.datasets[dataset]
+            metrics.latency.observe(latency)
+            metrics.in_flight.observe(in_flight)
+            metrics.counters["requests"] += 1
+            metrics.counters["retries"] += attempts - 1
+            metrics.counters["request_seconds"] += latency
+        self.maybe_flush()
+
+    def observe_result(self,dataset,latency,generated_tokens=None,finish_reason=None,write_seconds=0.0):
+        with self.lock:
+            metrics = self.datasets[dataset]
+            metrics.counters["completed"] += 1
+            metrics.counters["write_seconds"] += write_seconds
+            metrics.write_seconds.observe(write_seconds)
+            if generated_tokens is not None:
+                metrics.counters["generated_tokens"] += generated_tokens
+                metrics.generated_tokens.observe(generated_tokens)
+                if latency:
+                    metrics.tokens_per_second.observe(generated_tokens / latency)
+            if finish_reason is not None:
+                metrics.finish_reasons[str(finish_reason)] += 1
+
+    def observe_error(self,dataset,error):
+        with self.lock:
+            metrics = self.datasets[dataset]
+            metrics.counters["errors"] += 1
+            metrics.error_types[type(error).__name__] += 1
+
+    def observe_batch(self,dataset,batch_size,generate_seconds,write_seconds,generated_tokens=None):
+        # local generation answers a whole batch at once, every sample gets the batch latency
+        with self.lock:
+            metrics = self.datasets[dataset]
+            for _ in range(batch_size):
+                metrics.latency.observe(generate_seconds)
+            metrics.in_flight.observe(batch_size)
+            metrics.counters["requests"] += batch_size
+            metrics.counters["completed"] += batch_size
+            metrics.counters["request_seconds"] += generate_seconds
+            metrics.counters["write_seconds"] += write_seconds
+            metrics.write_seconds.observe(write_seconds)
+            if generated_tokens is not None:
+                metrics.counters["generated_tokens"] += generated_tokens
+                metrics.tokens_per_second.observe(generated_tokens / generate_seconds if generate_seconds else 0.0)
+        self.maybe_flush()
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for dataset,metrics in self.datasets.items():
+                elapsed = time.time() - metrics.started
+                snapshot[dataset] = {"elapsed":elapsed,"counters":dict(metrics.counters),
+                                     "requests_per_second":metrics.counters["completed"] / elapsed if elapsed > 0 else 0.0,
+                                     "finish_reasons":dict(metrics.finish_reasons),"error_types":dict(metrics.error_types),
+                                     "latency_seconds":metrics.latency.to_dict(),
+                                     "generated_tokens":metrics.generated_tokens.to_dict(),
+                                     "tokens_per_second":metrics.tokens_per_second.to_dict(),
+                                     "write_seconds":metrics.write_seconds.to_dict(),
+                                     "in_flight":metrics.in_flight.to_dict()}
+            return snapshot
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            datasets = list(self.datasets.items())
+            counters = sorted({name for _,metrics in datasets for name in metrics.counters})
+            for name in counters:
+                lines.append(f"# TYPE medhalt_{name}_total counter")
+                lines.extend(f'medhalt_{name}_total{{dataset="{dataset}"}} {metrics.counters[name]}' for dataset,metrics in datasets)
+            for name,attribute in [("finish_reason","finish_reasons"),("error_type","error_types")]:
+                lines.append(f"# TYPE medhalt_{name}s_total counter")
+                for dataset,metrics in datasets:
+                    lines.extend(f'medhalt_{name}s_total{{dataset="{dataset}",{name}="{value}"}} {count}'
+                                 for value,count in getattr(metrics,attribute).items())
+            for name in ["latency","generated_tokens","tokens_per_second","write_seconds","in_flight"]:
+                metric = f"medhalt_request_{name}" + ("_seconds" if name == "latency" else "")
+                lines.append(f"# TYPE {metric} histogram")
+                for dataset,metrics in datasets:
+                    histogram = getattr(metrics,name)
+                    for bound,count in zip([str(b) for b in histogram.buckets] + ["+Inf"],histogram.cumulative()):
+                        lines.append(f'{metric}_bucket{{dataset="{dataset}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_sum{{dataset="{dataset}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{dataset="{dataset}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if self.path is None:
+            return
+        self.last_flush = time.monotonic()
+        content = json.dumps(self.snapshot(),indent=2) if self.path.endswith(".json") else self.prometheus()
+        # written aside and renamed, a scraper never reads half a file
+        with open(self.path + ".tmp",'w') as fp:
+            fp.write(content)
+        os.replace(self.path + ".tmp",self.path)
+
+    def maybe_flush(self):
+        if self.path is not None and time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def summary(self,dataset):
+        metrics = self.snapshot().get(dataset)
+        if metrics is None:
+            return
+        counters = metrics["counters"]
+        latency = metrics["latency_seconds"]
+        rate = metrics["tokens_per_second"]
+        print(f"{dataset}: {counters.get('completed',0)} completed, {counters.get('errors',0)} failed, "
+              f"{counters.get('retries',0)} retries, {metrics['requests_per_second']:.1f} req/s")
+        print(f"  latency p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s, "
+              f"tokens/s per request p50 {rate['p50']:.1f}, in flight p50 {metrics['in_flight']['p50']:.0f}")
+        # request time is summed over the requests in flight, write time is spent on the client's only thread
+        print(f"  {counters.get('request_seconds',0.0):.1f}s in requests (summed over requests in flight), "
+              f"{counters.get('write_seconds',0.0):.2f}s writing predictions")
+        if metrics["finish_reasons"]:
+            print("  finish reasons " + ", ".join(f"{reason} {count}" for reason,count in metrics["finish_reasons"].items()))
+        if metrics["error_types"]:
+            print("  errors " + ", ".join(f"{error} {count}" for error,count in metrics["error_types"].items()))
+        self.flush()
@@ -1,28 +1,82 @@
-from typing import Optional,Callable
+from typing import Optional,Callable,Set,List
+import torch
 from datasets import load_dataset
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset,Sampler
+from transformers import StoppingCriteria
 import pandas as pd
 import os,sys
-from medhalt.prompts.utils import get_samples
+from medhalt.prompts.utils import get_samples,get_full_prompt
+from medhalt.prompts.artifacts import PromptArtifact,artifact_path
 
 class PromptDataset(Dataset):
     def __init__(
         self,
         dataset_name: str,
         prompt_template_fn: Optional[Callable[[],str]],
+        shots: int = 2,
+        prompt_version: str = 'v0',
+        instruction: Optional[str] = None,
+        skip_ids: Optional[Set[str]] = None,
+        num_shards: int = 1,
+        shard_index: int = 0,
+        artifact_folder: Optional[str] = None,
+        prompt_seed: Optional[int] = None,
     ):
         super().__init__() 
-        self.dataset = get_samples(dataset_name=dataset_name,shots=2,prompt_version='v0') 
+        self.dataset_name = dataset_name
+        self.shots = shots
+        self.prompt_version = prompt_version
+        self.prompt_seed = prompt_seed
+        if artifact_folder is not None:
+            # prompts compiled by medhalt.prompts.artifacts, samples are decoded from the memory mapped blob on access
+            path = artifact_path(artifact_folder,dataset_name,shots,prompt_version,prompt_seed)
+            if not os.path.exists(path + ".json"):
+                raise FileNotFoundError(f"No compiled prompts at {path}.json, build them with "
+                                        f"python -m medhalt.prompts.artifacts --output_folder {artifact_folder} "
+                                        f"--datasets {dataset_name} --shots {shots} --prompt_versions {prompt_version} --seeds {prompt_seed}")
+            self.source = PromptArtifact(path)
+            self.instruction = instruction if instruction is not None else self.source.instruction
+            self.ids = self.source.ids()
+        else:
+            self.instruction = instruction if instruction is not None else get_full_prompt(dataset_name,shots,prompt_version,prompt_seed)
+            self.source = get_samples(dataset_name=dataset_name,shots=shots,prompt_version=prompt_version,prompt=self.instruction) 
+            self.ids = [str(sample["id"]) for sample in self.source]
+        self.from_artifact = artifact_folder is not None
+        self.indices = list(range(len(self.ids)))
+        if num_shards > 1:
+            # strided shards get a similar mix of prompt lengths
+            self.indices = self.indices[shard_index::num_shards]
+        if skip_ids:
+            self.drop(skip_ids)
         self.prompt_template_fn = prompt_template_fn
 
     @staticmethod
     def _collate_fn(tokenizer,batch):
         prompts = [batch_item["prompt"] for batch_item in batch]
-        model_inputs = tokenizer.batch_encode_plus(
+        model_inputs = tokenizer(
             prompts, padding=True, add_special_tokens=False, return_tensors="pt"
         )
         #model_inputs = {keydel_inputs[key].to(device) for key in model_inputs}
         model_inputs["prompts"] = prompts
+        model_inputs["ids"] = [batch_item["id"] for batch_item in batch]
+        return model_inputs
+    
+    @staticmethod
+    def _prefix_collate_fn(tokenizer,prefix,prefix_ids,batch):
+        prompts = [batch_item["prompt"] for batch_item in batch]
+        assert all(prompt.startswith(prefix) for prompt in prompts), "prompts do not start with the shared prefix"
+        # whole prompts are tokenized so tokens merging across the prefix boundary come out as without the cache
+        input_ids = tokenizer(prompts,add_special_tokens=False)["input_ids"]
+        prefix_length = len(prefix_ids)
+        if all(ids[:prefix_length] == prefix_ids for ids in input_ids):
+            model_inputs = tokenizer.pad({"input_ids":[ids[prefix_length:] for ids in input_ids]},return_tensors="pt")
+            model_inputs["prefix_length"] = prefix_length
+        else:
+            # a sample changes the tokens of the prefix, the batch is generated from the full prompts
+            model_inputs = tokenizer.pad({"input_ids":input_ids},return_tensors="pt")
+            model_inputs["prefix_length"] = None
+        model_inputs["prompts"] = prompts
+        model_inputs["ids"] = [batch_item["id"] for batch_item in batch]
         return model_inputs
     
     @staticmethod
@@ -34,8 +88,83 @@ class PromptDataset(Dataset):
         #model_inputs["prompts"] = prompts
         return prompts,ids
     
+    def drop(self,ids):
+        self.indices = [index for index in self.indices if self.ids[index] not in ids]
+    
+    def token_lengths(self,tokenizer):
+        prompts = [self[index]["prompt"] for index in range(len(self))]
+        if not prompts:
+            return []
+        return [len(input_ids) for input_ids in tokenizer(prompts,add_special_tokens=False)["input_ids"]]
+    
+    def sample(self, index):
+        sample = self.source[self.indices[index]]
+        if self.from_artifact:
+            sample["prompt"] = self.instruction + sample["prompt"]
+        return sample
+
     def __getitem__(self, index):
-        return self.prompt_template_fn(self.dataset[index])
+        return self.prompt_template_fn(self.sample(index))
 
     def __len__(self):
-        return len(self.dataset)
\ No newline at end of file
+        return len(self.indices)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Groups prompts of similar length into batches whose padded size stays under `max_batch_tokens`."""
+    def __init__(
+        self,
+        lengths: List[int],
+        max_batch_tokens: int,
+        max_batch_size: Optional[int] = None,
+    ):
+        # longest prompts first, so a batch that does not fit in memory fails at the start of the run
+        order = sorted(range(len(lengths)),key=lambda index: lengths[index],reverse=True)
+        self.batches = []
+        batch = []
+        for index in order:
+            # the first prompt of a sorted batch is its longest one
+            padded_tokens = lengths[batch[0]] * (len(batch) + 1) if batch else lengths[index]
+            if batch and (padded_tokens > max_batch_tokens or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def truncate_at_stop(text,stop_sequences):
+    # keep the text up to and including the first stop sequence, like text-generation-inference does
+    ends = [text.index(stop) + len(stop) for stop in stop_sequences if stop in text]
+    return text[:min(ends)] if ends else text
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Marks every sequence of the batch that produced one of `stop_sequences`, or ended with eos or pad, as done."""
+    def __init__(self, tokenizer, stop_sequences: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop_sequences = stop_sequences
+        self.prompt_length = prompt_length
+        # only the last few tokens have to be decoded to see a stop sequence that was just completed
+        self.window = max(len(tokenizer(stop,add_special_tokens=False)["input_ids"]) for stop in stop_sequences) + 2
+        self.end_ids = [token_id for token_id in {tokenizer.eos_token_id,tokenizer.pad_token_id} if token_id is not None]
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0],dtype=torch.bool,device=input_ids.device)
+        if input_ids.shape[1] > self.prompt_length:
+            self.done |= torch.isin(input_ids[:,-1],torch.tensor(self.end_ids,device=input_ids.device))
+        start = max(self.prompt_length,input_ids.shape[1] - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:,start:],skip_special_tokens=True)
+        for index,tail in enumerate(tails):
+            if not self.done[index] and any(stop in tail for stop in self.stop_sequences):
+                self.done[index] = True
+        # one flag per sequence, generate finishes the done ones and stops once all of them are
+        return self.done.clone()
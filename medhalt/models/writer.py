@@ -0,0 +1,246 @@
+import os,csv,json,time,queue,shutil,itertools,threading
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# generations are written as <dataset>.csv (id,text rows, what evaluate.py has always read),
+# <dataset>.predictions.jsonl or <dataset>.predictions.parquet (a folder of part files), the last two also keep the
+# token counts and timings of every sample
+PREDICTION_SUFFIXES = {"csv":".csv","jsonl":".predictions.jsonl","parquet":".predictions.parquet"}
+
+def prediction_format(pred_file):
+    for output_format in ["jsonl","parquet"]:
+        if pred_file.endswith(PREDICTION_SUFFIXES[output_format]):
+            return output_format
+    return "csv"
+
+def prediction_stem(pred_file):
+    return pred_file[:-len(PREDICTION_SUFFIXES[prediction_format(pred_file)])]
+
+def parquet_schema():
+    return pa.schema([("id",pa.string()),("generated_text",pa.string()),("input_tokens",pa.int64()),
+                      ("generated_tokens",pa.int64()),("latency_seconds",pa.float64()),("completed_at",pa.float64())])
+
+def parquet_parts(pred_file):
+    if not os.path.isdir(pred_file):
+        return []
+    return sorted(os.path.join(pred_file,name) for name in os.listdir(pred_file) if name.endswith(".parquet"))
+
+def parquet_readable(part):
+    try:
+        pq.read_metadata(part)
+        return True
+    except Exception:
+        return False
+
+
+class CsvSink:
+
+    def __init__(self,pred_file,fsync=False) -> None:
+        self.fsync = fsync
+        self.file = open(pred_file,'a',newline='')
+        self.writer = csv.writer(self.file)
+
+    def write(self,records):
+        self.writer.writerows([record["id"],record["generated_text"]] for record in records)
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(CsvSink):
+
+    def __init__(self,pred_file,fsync=False) -> None:
+        self.fsync = fsync
+        self.file = open(pred_file,'a')
+
+    def write(self,records):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+class ParquetSink:
+    """Writes a row group per flush to part files of the `pred_file` folder. A part is closed, which writes its
+    footer, every `part_flushes` flushes: a run that dies only loses the rows of its open part, which is unreadable
+    and dropped on resume."""
+
+    def __init__(self,pred_file,fsync=False,part_flushes=8) -> None:
+        assert pq is not None, "parquet predictions need pyarrow"
+        os.makedirs(pred_file,exist_ok=True)
+        self.folder = pred_file
+        self.fsync = fsync
+        self.part_flushes = part_flushes
+        self.schema = parquet_schema()
+        self.writer = None
+        self.path = None
+        self.flushes = 0
+
+    def next_path(self):
+        for index in itertools.count(len(parquet_parts(self.folder))):
+            path = os.path.join(self.folder,f"part-{index:05d}.parquet")
+            if not os.path.exists(path):
+                return path
+
+    def write(self,records):
+        if self.writer is None:
+            self.path = self.next_path()
+            self.writer = pq.ParquetWriter(self.path,self.schema)
+        self.writer.write_table(pa.Table.from_pylist(records,schema=self.schema))
+
+    def flush(self):
+        self.flushes += 1
+        if self.flushes >= self.part_flushes:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            if self.fsync:
+                with open(self.path,'rb') as fp:
+                    os.fsync(fp.fileno())
+            self.writer = None
+            self.flushes = 0
+
+
+SINKS = {"csv":CsvSink,"jsonl":JsonlSink,"parquet":ParquetSink}
+
+
+class PredictionWriter:
+    """Writes predictions from a background thread so the generation loop never waits on the file system.
+
+    Records go through a queue of at most `max_queue` records, `write` blocks while it is full. The thread buffers
+    them and hands them to the sink every `flush_rows` records or `flush_seconds` seconds, whichever comes first,
+    and fsyncs after each flush when `fsync` is set (parquet ones when a part is closed, every `part_flushes`
+    flushes). Errors of the thread are raised by the next `write` or `close`.
+    """
+
+    def __init__(self,pred_file,flush_rows=256,flush_seconds=5.0,fsync=False,max_queue=1024,part_flushes=8) -> None:
+        self.pred_file = pred_file
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        output_format = prediction_format(pred_file)
+        sink_kwargs = {"part_flushes":part_flushes} if output_format == "parquet" else {}
+        self.sink = SINKS[output_format](pred_file,fsync=fsync,**sink_kwargs)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+    def _flush(self,buffer):
+        if buffer and self.error is None:
+            try:
+                self.sink.write(buffer)
+                self.sink.flush()
+            except Exception as e:
+                self.error = e
+        buffer.clear()
+
+    def _run(self):
+        buffer = []
+        deadline = time.monotonic() + self.flush_seconds
+        while True:
+            try:
+                record = self.queue.get(timeout=max(deadline - time.monotonic(),0.001))
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                buffer.append(record)
+            if len(buffer) >= self.flush_rows or time.monotonic() >= deadline:
+                self._flush(buffer)
+                deadline = time.monotonic() + self.flush_seconds
+        self._flush(buffer)
+        try:
+            self.sink.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def write(self,_id,generated_text,input_tokens=None,generated_tokens=None,latency_seconds=None):
+        """Queues a prediction, returns the seconds spent waiting for room in the queue."""
+        if self.error is not None:
+            raise self.error
+        started = time.perf_counter()
+        self.queue.put({"id":str(_id),"generated_text":generated_text,
+                        "input_tokens":None if input_tokens is None else int(input_tokens),
+                        "generated_tokens":None if generated_tokens is None else int(generated_tokens),
+                        "latency_seconds":latency_seconds,"completed_at":time.time()})
+        return time.perf_counter() - started
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def read_records(pred_file):
+    """Yields the predictions of `pred_file` as record dicts, csv files only have the id and generated_text."""
+    output_format = prediction_format(pred_file)
+    if output_format == "csv":
+        with open(pred_file,'r',newline='') as f:
+            for row in csv.reader(f):
+                if row:
+                    yield {"id":row[0],"generated_text":row[1] if len(row) > 1 else ""}
+    elif output_format == "jsonl":
+        with open(pred_file,'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        for part in parquet_parts(pred_file):
+            for batch in pq.ParquetFile(part).iter_batches():
+                yield from batch.to_pylist()
+
+def write_records(pred_file,records,batch_rows=8192):
+    # streamed to a file aside and moved in place, the predictions are never half rewritten
+    output_format = prediction_format(pred_file)
+    records = iter(records)
+    if output_format == "parquet":
+        tmp_folder = pred_file + ".tmp"
+        shutil.rmtree(tmp_folder,ignore_errors=True)
+        os.makedirs(tmp_folder)
+        with pq.ParquetWriter(os.path.join(tmp_folder,"part-00000.parquet"),parquet_schema()) as writer:
+            for batch in iter(lambda: list(itertools.islice(records,batch_rows)),[]):
+                writer.write_table(pa.Table.from_pylist(batch,schema=writer.schema))
+        shutil.rmtree(pred_file,ignore_errors=True)
+        os.replace(tmp_folder,pred_file)
+        return
+    with open(pred_file + ".tmp",'w',newline='') as f:
+        writer = csv.writer(f)
+        for record in records:
+            if output_format == "csv":
+                writer.writerow([record["id"],record["generated_text"]])
+            else:
+                f.write(json.dumps(record) + "\n")
+    os.replace(pred_file + ".tmp",pred_file)
+
+def iter_predictions(pred_file,chunk_size=2048):
+    """Yields DataFrames of `chunk_size` predictions with the id and output columns."""
+    output_format = prediction_format(pred_file)
+    if output_format == "csv":
+        yield from pd.read_csv(pred_file,names=["id","output"],chunksize=chunk_size)
+    elif output_format == "jsonl":
+        for chunk in pd.read_json(pred_file,lines=True,dtype={"id":str},chunksize=chunk_size):
+            yield chunk[["id","generated_text"]].rename(columns={"generated_text":"output"})
+    else:
+        for part in parquet_parts(pred_file):
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=chunk_size,columns=["id","generated_text"]):
+                yield batch.to_pandas().rename(columns={"generated_text":"output"})
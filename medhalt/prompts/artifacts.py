@@ -0,0 +1,125 @@
+import os
+import json
+import mmap
+import hashlib
+import numpy as np
+from medhalt.prompts.utils import CURRENT_FOLDER,DATASETS_FOLDER,data_dict,prompt_dict,load_dataset,get_full_prompt
+
+ARTIFACTS_FOLDER = os.path.join(CURRENT_FOLDER,"compiled")
+
+
+def artifact_path(folder, dataset_name, shots, prompt_version, seed):
+    return os.path.join(folder, f"{dataset_name}_s{shots}_{prompt_version}_seed{seed}")
+
+
+def source_fingerprint(dataset_name, block_size=1 << 20):
+    # the dataset csv and the task's prompts.json and shots.json the artifact was compiled from
+    prompt_folder = os.path.join(CURRENT_FOLDER, prompt_dict[dataset_name])
+    digest = hashlib.sha256()
+    for path in [os.path.join(DATASETS_FOLDER, data_dict[dataset_name]), os.path.join(prompt_folder, 'prompts.json'),
+                 os.path.join(prompt_folder, 'shots.json')]:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class PromptArtifact(object):
+    """Read-only view of prompts compiled by `build_artifact`.
+
+    `<path>.json` holds the shared instruction and metadata, `<path>.bin` the utf-8 encoded ids and prompt
+    suffixes back to back, and `<path>.offsets.npy` the byte offsets delimiting them (2 per sample). Both
+    files are memory mapped on first access, so only the samples that are read are paged in. Artifacts whose
+    dataset or prompt files changed since they were compiled are rebuilt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json", 'r') as fp:
+            self.header = json.load(fp)
+        header = self.header
+        if header.get('fingerprint') != source_fingerprint(header['dataset_name']):
+            print(f"Sources of {path} changed, rebuilding")
+            build_artifact(os.path.dirname(path), header['dataset_name'], header['shots'], header['prompt_version'],
+                           header['seed'])
+            with open(path + ".json", 'r') as fp:
+                self.header = json.load(fp)
+        self.instruction = self.header['instruction']
+        self._offsets = None
+        self._blob = None
+
+    def _open(self):
+        if self._offsets is None:
+            self._offsets = np.load(self.path + ".offsets.npy", mmap_mode='r')
+            if self._offsets[-1] > 0:
+                with open(self.path + ".bin", 'rb') as fp:
+                    self._blob = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._blob = b""
+
+    def _field(self, index):
+        self._open()
+        return self._blob[self._offsets[index]:self._offsets[index + 1]].decode('utf-8')
+
+    def ids(self):
+        return [self._field(2 * index) for index in range(len(self))]
+
+    def __len__(self):
+        return self.header['count']
+
+    def __getitem__(self, index):
+        return {'id': self._field(2 * index), 'prompt': self._field(2 * index + 1)}
+
+
+def build_artifact(folder, dataset_name, shots, prompt_version, seed):
+    instruction = get_full_prompt(dataset_name, shots, prompt_version, seed)
+
+    dataset = load_dataset(dataset_name)
+    fields = []
+    for _id, prompt in zip(dataset['id'], dataset['prompt']):
+        fields.append(str(_id).encode('utf-8'))
+        fields.append(str(prompt).encode('utf-8'))
+    offsets = np.zeros(len(fields) + 1, dtype=np.int64)
+    np.cumsum([len(field) for field in fields], out=offsets[1:])
+
+    path = artifact_path(folder, dataset_name, shots, prompt_version, seed)
+    os.makedirs(folder, exist_ok=True)
+    with open(path + ".bin", 'wb') as fp:
+        fp.write(b"".join(fields))
+    np.save(path + ".offsets.npy", offsets)
+    header = {'dataset_name': dataset_name, 'shots': shots, 'prompt_version': prompt_version, 'seed': seed,
+              'count': len(dataset), 'instruction': instruction, 'fingerprint': source_fingerprint(dataset_name)}
+    with open(path + ".json", 'w') as fp:
+        json.dump(header, fp, indent=2)
+    return path
+
+
+def build_prompts(folder, dataset_names, shots_list, prompt_versions, seeds):
+    for dataset_name in dataset_names:
+        if not os.path.exists(os.path.join(DATASETS_FOLDER, data_dict[dataset_name])):
+            print(f"Skipping {dataset_name} - {data_dict[dataset_name]} not found in {DATASETS_FOLDER}")
+            continue
+        for shots in shots_list:
+            for prompt_version in prompt_versions:
+                for seed in seeds:
+                    path = build_artifact(folder, dataset_name, shots, prompt_version, seed)
+                    print(f"Built {path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile prompts for every (task, shots, prompt_version, seed) combination")
+    parser.add_argument("--output_folder", type=str, default=ARTIFACTS_FOLDER)
+    parser.add_argument("--datasets", type=str, default=",".join(data_dict))
+    parser.add_argument("--shots", type=str, default="2")
+    parser.add_argument("--prompt_versions", type=str, default="v0")
+    parser.add_argument("--seeds", type=str, default="42")
+
+    args = parser.parse_args()
+
+    build_prompts(args.output_folder,
+                  args.datasets.split(","),
+                  [int(shots) for shots in args.shots.split(",")],
+                  args.prompt_versions.split(","),
+                  [int(seed) for seed in args.seeds.split(",")])
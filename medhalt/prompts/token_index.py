@@ -0,0 +1,177 @@
+import os
+import re
+import hashlib
+import numpy as np
+from medhalt.prompts.utils import DATASETS_FOLDER,data_dict,load_dataset,get_full_prompt
+
+INDEX_FOLDER = os.path.join(DATASETS_FOLDER,"token_index")
+
+# what happens to a sample whose prompt is longer than max_input_tokens: its sample part is truncated, fewer shots
+# are tried before truncating, or it is not sent and recorded in <dataset>.deferred.jsonl instead
+OVERFLOW_POLICIES = ["truncate","shots","defer"]
+
+
+def index_path(folder,dataset_name,tokenizer_name):
+    slug = re.sub(r"[^\w.-]+","_",tokenizer_name)
+    return os.path.join(folder,f"{dataset_name}.{slug}.npz")
+
+
+def text_fingerprint(texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def count_tokens(tokenizer,texts,batch_size=1024):
+    counts = np.zeros(len(texts),dtype=np.int32)
+    for start in range(0,len(texts),batch_size):
+        input_ids = tokenizer(texts[start:start + batch_size],add_special_tokens=False)["input_ids"]
+        counts[start:start + len(input_ids)] = [len(ids) for ids in input_ids]
+    return counts
+
+
+def sample_texts(dataset_name):
+    dataset = load_dataset(dataset_name)
+    return dataset['id'].map(str).tolist(),dataset['prompt'].map(str).tolist()
+
+
+class TokenIndex(object):
+    """Token counts of the sample part of every prompt of a dataset (the prompt without the instruction and shots),
+    for one tokenizer. The counts are stored next to the datasets and rebuilt when the formatted samples change."""
+
+    def __init__(self,path):
+        with np.load(path) as data:
+            self.ids = data['ids'].tolist()
+            self.counts = data['counts']
+            self.fingerprint = str(data['fingerprint'])
+        self.position = {_id:index for index,_id in enumerate(self.ids)}
+
+    def count(self,_id):
+        return int(self.counts[self.position[str(_id)]])
+
+
+def build_index(dataset_name,tokenizer,tokenizer_name,folder=INDEX_FOLDER,texts=None):
+    ids,prompts = texts or sample_texts(dataset_name)
+    path = index_path(folder,dataset_name,tokenizer_name)
+    os.makedirs(folder,exist_ok=True)
+    with open(path + ".tmp",'wb') as fp:
+        np.savez(fp,ids=np.array(ids),counts=count_tokens(tokenizer,prompts),fingerprint=text_fingerprint(prompts))
+    os.replace(path + ".tmp",path)
+    return TokenIndex(path)
+
+
+def load_index(dataset_name,tokenizer,tokenizer_name,folder=INDEX_FOLDER):
+    texts = sample_texts(dataset_name)
+    path = index_path(folder,dataset_name,tokenizer_name)
+    if os.path.exists(path):
+        index = TokenIndex(path)
+        if index.fingerprint == text_fingerprint(texts[1]):
+            return index
+        print(f"Samples of {dataset_name} changed, rebuilding {path}")
+    return build_index(dataset_name,tokenizer,tokenizer_name,folder,texts)
+
+
+class TokenBudget(object):
+    """Fits the prompts of a PromptDataset into the limits of a text-generation-inference server before they are sent.
+
+    Mirrors `--max-input-length` and `--max-total-tokens` of the server: prompts longer than `max_input_tokens` are
+    handled by `overflow`, and `max_new_tokens` of every request is cut to what `max_total_tokens` leaves. Token
+    counts come from the TokenIndex, concatenated texts can tokenize slightly differently so `margin` tokens are kept
+    free.
+    """
+
+    def __init__(self,tokenizer,tokenizer_name,max_input_tokens,max_total_tokens=None,overflow="truncate",margin=8,
+                 tail_tokens=8,folder=INDEX_FOLDER):
+        assert overflow in OVERFLOW_POLICIES, f"overflow has to be one of {OVERFLOW_POLICIES}"
+        self.tokenizer = tokenizer
+        self.tokenizer_name = tokenizer_name
+        self.max_input_tokens = max_input_tokens
+        self.max_total_tokens = max_total_tokens
+        self.overflow = overflow
+        self.margin = margin
+        self.tail_tokens = tail_tokens
+        self.folder = folder
+        self._instruction_tokens = {}
+
+    def instruction_tokens(self,instruction):
+        if instruction not in self._instruction_tokens:
+            self._instruction_tokens[instruction] = len(self.tokenizer(instruction,add_special_tokens=False)["input_ids"])
+        return self._instruction_tokens[instruction]
+
+    def truncate(self,text,max_tokens):
+        # the start of the sample is kept with its last tokens, which close the input and open the output
+        input_ids = self.tokenizer(text,add_special_tokens=False)["input_ids"]
+        if len(input_ids) <= max_tokens:
+            return text
+        tail = min(self.tail_tokens,max_tokens)
+        return self.tokenizer.decode(input_ids[:max_tokens - tail]) + self.tokenizer.decode(input_ids[len(input_ids) - tail:])
+
+    @staticmethod
+    def seed(dataset):
+        # unseeded datasets still get one reduced instruction per shot count
+        return dataset.prompt_seed if dataset.prompt_seed is not None else 0
+
+    def fewer_shots(self,dataset,tokens):
+        # the same reduced instruction is used for every long sample of a dataset
+        instruction = dataset.instruction
+        for shots in range(dataset.shots - 1,-1,-1):
+            instruction = get_full_prompt(dataset.dataset_name,shots,dataset.prompt_version,self.seed(dataset))
+            if self.instruction_tokens(instruction) + tokens + self.margin <= self.max_input_tokens:
+                break
+        return instruction
+
+    def plan(self,dataset,max_new_tokens):
+        """Returns ([(prompt,id,budget)],[deferred (id,input_tokens)]) for the samples of `dataset`. A budget holds the
+        input tokens, the max_new_tokens of the request and whether the prompt was changed to fit."""
+        index = load_index(dataset.dataset_name,self.tokenizer,self.tokenizer_name,self.folder)
+        instruction_tokens = self.instruction_tokens(dataset.instruction)
+        requests,deferred = [],[]
+        for position in range(len(dataset)):
+            sample = dataset[position]
+            prompt,_id = sample["prompt"],sample["id"]
+            tokens = index.count(_id)
+            input_tokens = instruction_tokens + tokens + self.margin
+            modified = False
+            if input_tokens > self.max_input_tokens:
+                if self.overflow == "defer":
+                    deferred.append((_id,input_tokens))
+                    continue
+                instruction = dataset.instruction
+                if self.overflow == "shots":
+                    instruction = self.fewer_shots(dataset,tokens)
+                suffix = prompt[len(dataset.instruction):]
+                room = self.max_input_tokens - self.instruction_tokens(instruction) - self.margin
+                prompt = instruction + self.truncate(suffix,max(room,0))
+                input_tokens = self.instruction_tokens(instruction) + min(tokens,max(room,0)) + self.margin
+                modified = True
+            new_tokens = max_new_tokens
+            if self.max_total_tokens is not None and new_tokens is not None:
+                new_tokens = min(new_tokens,self.max_total_tokens - input_tokens)
+                if new_tokens < 1:
+                    deferred.append((_id,input_tokens))
+                    continue
+            requests.append((prompt,_id,{"input_tokens":input_tokens,"max_new_tokens":new_tokens,
+                                         "modified":modified or new_tokens != max_new_tokens}))
+        return requests,deferred
+
+
+if __name__ == "__main__":
+    import argparse
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Count the tokens of every sample of the datasets for a tokenizer")
+    parser.add_argument("--tokenizer",type=str)
+    parser.add_argument("--datasets",type=str,default=",".join(data_dict))
+    parser.add_argument("--output_folder",type=str,default=INDEX_FOLDER)
+
+    args = parser.parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    for dataset_name in args.datasets.split(","):
+        if not os.path.exists(os.path.join(DATASETS_FOLDER,data_dict[dataset_name])):
+            print(f"Skipping {dataset_name} - {data_dict[dataset_name]} not found in {DATASETS_FOLDER}")
+            continue
+        index = load_index(dataset_name,tokenizer,args.tokenizer,args.output_folder)
+        print(f"{dataset_name}: {len(index.ids)} samples, max {index.counts.max()} tokens, "
+              f"mean {index.counts.mean():.0f}")
@@ -2,6 +2,8 @@ import pandas as pd
 import json
 import random
 import os
+import ast
+from functools import lru_cache
 
 CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
 DATASETS_FOLDER = os.path.join(CURRENT_FOLDER,"../datasets")
@@ -34,36 +36,45 @@ data_dict = {
 
 
 
+@lru_cache(maxsize=None)
+def _options_repr(options):
+    # options are stored as the repr of a dict, parse each distinct one once
+    return repr(ast.literal_eval(options))
+
+
+def _dict_prompt(key, values):
+    # same text as "Input: " + str({key: value}) + "\nOutput: ", built a column at a time
+    return "Input: {" + repr(key) + ": " + values.map(repr) + "}\nOutput: "
+
+
 def Nota_format(data_):
-    data_['prompt'] = data_.apply(lambda row: "Input: " + str({"Question": row['question'], "Options": eval(row['options'])}) + "\nOutput: ", axis=1)
+    options = data_['options'].map(_options_repr)
+    data_['prompt'] = "Input: {'Question': " + data_['question'].map(repr) + ", 'Options': " + options + "}\nOutput: "
     return data_
 
 def pmid2title_format(data_):
-    data_['prompt'] = data_.apply(lambda row: "Input: " + str({"Pmid": str(int(row["PMID"]))}), axis=1)
-    data_['prompt'] = data_['prompt'].apply(lambda x: str(x) + "\n" + "Output: ")
+    data_['prompt'] = _dict_prompt("Pmid", data_["PMID"].map(int).map(str))
     return data_
 
 
 def abs2pub_format(data_):
-    data_['prompt'] = data_.apply(lambda row: "Input: " + str({"paper_abstract": str(row["Abstract"])}), axis=1)
-    data_['prompt'] = data_['prompt'].apply(lambda x: str(x) + "\n" + "Output: ")
+    data_['prompt'] = _dict_prompt("paper_abstract", data_["Abstract"].map(str))
     return data_
 
 
 def url2title_format(data_):
-    data_['prompt'] = data_.apply(lambda row: "Input: " + str({"url": str(row["url"])}), axis=1)
-    data_['prompt'] = data_['prompt'].apply(lambda x: str(x) + "\n" + "Output: ")
+    data_['prompt'] = _dict_prompt("url", data_["url"].map(str))
     return data_
 
 def title2pub_format(data_):
-    data_['prompt'] = data_.apply(lambda row: "Input: " + str({"paper_title": str(row["Title"])}), axis=1)
-    data_['prompt'] = data_['prompt'].apply(lambda x: str(x) + "\n" + "Output: ")
+    data_['prompt'] = _dict_prompt("paper_title", data_["Title"].map(str))
     return data_
 
 
-def get_samples(dataset_name, shots, prompt_version):
+def get_samples(dataset_name, shots, prompt_version, prompt = None, seed = None):
     
-    prompt  = get_full_prompt(dataset_name, shots, prompt_version)
+    if prompt is None:
+        prompt  = get_full_prompt(dataset_name, shots, prompt_version, seed)
     dataset = load_dataset(dataset_name)
     dataset['prompt'] = dataset['prompt'].apply(lambda x: prompt + str(x))
     dataset = dataset.to_dict('records')
@@ -71,6 +82,10 @@ def get_samples(dataset_name, shots, prompt_version):
     return dataset
 
 
+def load_ids(dataset_name):
+    return pd.read_csv(os.path.join(DATASETS_FOLDER,data_dict[dataset_name]),usecols=['id'])['id'].astype(str).tolist()
+
+
 def load_dataset(dataset_name):
     
     df = pd.read_csv(os.path.join(DATASETS_FOLDER,data_dict[dataset_name]))
@@ -91,54 +106,39 @@ def load_dataset(dataset_name):
     return df
 
 
-def prompt_data(prompt_name, version, n_shots):
-    
-    prompt    = read_json_(f"{os.path.join(CURRENT_FOLDER,prompt_dict[prompt_name],'prompts.json')}")['prompts']
-    prompt    = [prompt_ for prompt_ in prompt if prompt_['id'] == version][0]
-    
-    shots     = read_json_(f"{os.path.join(CURRENT_FOLDER,prompt_dict[prompt_name],'shots.json')}")['shots'][0]
-    
+@lru_cache(maxsize=None)
+def load_prompt_files(prompt_name):
+    # every task's prompts.json and shots.json are read once per process, callers must not modify them
+    folder = os.path.join(CURRENT_FOLDER,prompt_dict[prompt_name])
+    prompts = read_json_(os.path.join(folder,'prompts.json'))['prompts']
+    shots = read_json_(os.path.join(folder,'shots.json'))['shots'][0]
     default_p = [shot_ for shot_ in shots if shot_['prompt_type'] == 'default']
     task_p    = [shot_ for shot_ in shots if shot_['prompt_type'] != 'default']
+    return {prompt_['id']: prompt_ for prompt_ in prompts}, default_p, task_p
+
+
+# n_shots -> (default shots, task specific shots)
+SHOT_MIX = {1: (1, 0), 2: (1, 1), 3: (2, 1), 4: (2, 2), 5: (3, 2)}
+
+
+def prompt_data(prompt_name, version, n_shots, seed=None):
     
+    prompts, default_p, task_p = load_prompt_files(prompt_name)
+    prompt = prompts[version]
     
     if n_shots == 0:
         return {'prompt' : prompt, 'shots' : None}
     
-    if n_shots == 1:
-        return {'prompt' : prompt, 'shots' : random.sample(default_p, 1)}
-    
-    elif n_shots == 2:
-        
-        se_shots = random.sample(default_p, 1)
-        other_p  = random.sample(task_p, 1)
-        se_shots.extend(other_p)
-        return {'prompt' : prompt, 'shots' : se_shots}
-    
-    elif n_shots == 3:
-        
-        se_shots = random.sample(default_p, 2)
-        other_p  = random.sample(task_p, 1)
-        se_shots.extend(other_p)
-        return {'prompt' : prompt, 'shots' : se_shots}
-    
-    elif n_shots == 4:
-        
-        se_shots = random.sample(default_p, 2)
-        other_p  = random.sample(task_p, 2)
-        se_shots.extend(other_p)
-        return {'prompt' : prompt, 'shots' : se_shots}
-    
-    elif n_shots == 5:
-        
-        se_shots = random.sample(default_p, 3)
-        other_p  = random.sample(task_p, 2)
-        se_shots.extend(other_p)
-        return {'prompt' : prompt, 'shots' : se_shots}
+    # a seeded generator draws the same shots as random.seed(seed) followed by the unseeded draws
+    rng = random.Random(seed) if seed is not None else random
+    n_default, n_task = SHOT_MIX[n_shots]
+    se_shots = rng.sample(default_p, n_default)
+    if n_task:
+        se_shots.extend(rng.sample(task_p, n_task))
+    return {'prompt' : prompt, 'shots' : se_shots}
 
-    
-def get_full_prompt(prompt_name, n_shots = 2, version = 'v0'):
-    prompt = prompt_data(prompt_name, version, n_shots)
+
+def render_prompt(prompt):
     if prompt['shots'] == None:
         return prompt['prompt']['prompt'] + '\n' + prompt['prompt']['output_format'] + '\n'
     else:
@@ -150,7 +150,19 @@ def get_full_prompt(prompt_name, n_shots = 2, version = 'v0'):
         return final
 
 
-def get_sample_Dataset(n_shots, version):
+@lru_cache(maxsize=None)
+def _seeded_prompt(prompt_name, n_shots, version, seed):
+    return render_prompt(prompt_data(prompt_name, version, n_shots, seed))
+
+
+def get_full_prompt(prompt_name, n_shots = 2, version = 'v0', seed = None):
+    # seeded prefixes are rendered once per (task, n_shots, version, seed), unseeded ones draw new shots every call
+    if seed is not None:
+        return _seeded_prompt(prompt_name, n_shots, version, seed)
+    return render_prompt(prompt_data(prompt_name, version, n_shots))
+
+
+def get_sample_Dataset(n_shots, version, seed=42):
     
     df = pd.read_csv(os.path.join(DATASETS_FOLDER,'data_sample.csv'))
     df_d = df.to_dict('records')
@@ -160,7 +172,7 @@ def get_sample_Dataset(n_shots, version):
     
     for index_, sample in enumerate(df_d):
         if sample['dataset_name'] == 'reasoning_fake':
-            prompt_ = get_full_prompt('fake', n_shots, version)
+            prompt_ = get_full_prompt('fake', n_shots, version, seed)
             data_   = f"Input : {sample['qo']}\nOutput: " 
             full_input = prompt_ + data_
             df_d[index_]['prompt'] = full_input
@@ -168,7 +180,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'reasoning_nota':
 
-            prompt_ = get_full_prompt('Nota', n_shots, version)
+            prompt_ = get_full_prompt('Nota', n_shots, version, seed)
             data_   = f"Input : {sample['qo']}" 
             full_input = prompt_ + data_
             df_d[index_]['prompt'] = full_input
@@ -176,7 +188,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'reasoning_FCT':
 
-            prompt_ = get_full_prompt('FCT', n_shots, version)
+            prompt_ = get_full_prompt('FCT', n_shots, version, seed)
             data_   = f"Input : {sample['qo']}" 
             full_input = prompt_ + data_
             df_d[index_]['prompt'] = full_input
@@ -185,7 +197,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'IR_pubmedlink2title':
 
-            prompt_ = get_full_prompt('url2title', n_shots, version)
+            prompt_ = get_full_prompt('url2title', n_shots, version, seed)
             samplen = str({'url': sample['url']})
             data_   = f"Input: {samplen}\nOutput: "
             full_input = prompt_ + data_
@@ -195,7 +207,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'IR_title2pubmedlink':
 
-            prompt_ = get_full_prompt('title2pub', n_shots, version)
+            prompt_ = get_full_prompt('title2pub', n_shots, version, seed)
             samplen = str({'paper_title': sample['Title']})
             data_   = f"Input: {samplen}\nOutput: "
             full_input = prompt_ + data_
@@ -204,7 +216,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'IR_pmid2title':
 
-            prompt_ = get_full_prompt('pmid2title', n_shots, version)
+            prompt_ = get_full_prompt('pmid2title', n_shots, version, seed)
             samplen = str({'Pmid': str(int(sample["PMID"]))})
             data_   = f"Input: {samplen}\nOutput: "
             full_input = prompt_ + data_
@@ -213,7 +225,7 @@ def get_sample_Dataset(n_shots, version):
 
         elif sample['dataset_name'] == 'IR_abstract2pubmedlink':
 
-            prompt_ = get_full_prompt('abs2pub', n_shots, version)
+            prompt_ = get_full_prompt('abs2pub', n_shots, version, seed)
             samplen = str({"paper_abstract": sample["Abstract"]})
             data_   = f"Input: {samplen}\nOutput: "
             full_input = prompt_ + data_
@@ -1,25 +1,12 @@
 #!/bin/bash
 datasets_folder=$1
 prediction_folder=$2
+# processes shared by the models being scored, defaults to the cpu count
+num_workers=${3-$(nproc)}
 
-declare -a folders=(
-				"falcon-40b-2"
-				"falcon-40b-instruct-2"
-				"Llama-2-70b-hf"
-				"Llama-2-70b-hf-chat"
-				"Llama-2-13b-hf"
-				"Llama-2-13b-hf-chat"
-				"Llama-2-7b-hf"
-				"Llama-2-7b-hf-chat"
-				"mpt-7b"
-				"mpt-7b-instruct"
-				)
-
-for key in "${folders[@]}":
-do
-	echo "Running prediction for ${key}"
-	python3 evaluate.py \
-		--prediction_folder=${prediction_folder}/${key} \
-		--dataset_folder=${datasets_folder} \
-		--do_json_conversion
-done
+# scores every model folder of ${prediction_folder} whose predictions changed since the last run
+# and writes the combined table to ${prediction_folder}/leaderboard.csv
+python3 leaderboard.py \
+	--prediction_root=${prediction_folder} \
+	--dataset_folder=${datasets_folder} \
+	--num_workers=${num_workers}